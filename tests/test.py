@@ -1,6 +1,20 @@
 import unittest
 import logging
+import io, json, os, shutil, tempfile
+import concurrent.futures
+import socket, threading, time
+import urllib.request, urllib.error
+from http.server import HTTPServer, BaseHTTPRequestHandler
 import ytmm
+from ytmm.pacing import Pacer, METADATA, MEDIA
+from ytmm.shards import ShardedStore
+from ytmm.utils import video_id_from_url
+from ytmm.locate import find_database, location_cache_file
+from ytmm import client
+from ytmm.fingerprint import FingerprintIndex, content_hash, title_key
+from ytmm.transcode import SourceCache, OutputProfile, load_profiles
+from ytmm.ytmm import use_console
+from rich.console import Console
 
 class TestYoutubeMM(unittest.TestCase):
     @classmethod
@@ -30,5 +44,559 @@ class TestYoutubeMM(unittest.TestCase):
     #    item = "{'id': 'abcde_12345', 'title': 'test', 'artists': ['name1', 'name2'], 'location': 'album_name'}"
     #    self.assertIn(item, cm.output[0])
 
+class ThrottlingServer(HTTPServer):
+    """Local stub server that answers 429 to the first `throttle` requests"""
+    def __init__(self, throttle: int):
+        self.throttle = throttle
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                with self.lock:
+                    self.requests += 1
+                    status = 429 if self.requests <= self.throttle else 200
+                handler.send_response(status)
+                handler.end_headers()
+                handler.wfile.write(b'ok')
+            def log_message(handler, *args):
+                pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+
+class TestPacer(unittest.TestCase):
+    def test_backoff_shared_by_workers(self):
+        server = ThrottlingServer(throttle=2)
+        self.addCleanup(server.shutdown)
+        pacer = Pacer(rate=0, base_delay=0.05, max_delay=0.2)
+        statuses = []
+        results = []
+
+        def worker():
+            for _ in range(5):
+                pacer.acquire(MEDIA)
+                try:
+                    urllib.request.urlopen(server.url()).read()
+                    pacer.succeeded()
+                    results.append(True)
+                    return
+                except urllib.error.HTTPError as e:
+                    pacer.check_message(f'HTTP Error {e.code}: Too Many Requests')
+            results.append(False)
+
+        with pacer.listen(statuses.append):
+            workers = [threading.Thread(target=worker) for _ in range(4)]
+            for w in workers: w.start()
+            for w in workers: w.join()
+
+        self.assertEqual(results, [True]*4)
+        self.assertTrue(any(s.startswith('backing off') for s in statuses))
+        self.assertEqual(statuses[-1], '')
+        # Requests stop while the breaker is open instead of every worker retrying
+        self.assertLessEqual(server.requests, 6)
+
+    def test_exponential_backoff(self):
+        now = [0.0]
+        pacer = Pacer(base_delay=1, max_delay=5, clock=lambda: now[0])
+        delays = []
+        for _ in range(5):
+            delays.append(pacer.throttled())
+            now[0] += delays[-1]
+        self.assertEqual(delays, [1, 2, 4, 5, 5])
+
+    def test_backoff_window_counts_once(self):
+        now = [0.0]
+        pacer = Pacer(base_delay=1, max_delay=5, clock=lambda: now[0])
+        # Fragments of several workers failing together
+        self.assertEqual([pacer.throttled() for _ in range(8)], [1]*8)
+        self.assertEqual(pacer.breaker.failures, 1)
+
+    def test_retry_sleep_only_waits_when_throttled(self):
+        pacer = Pacer(base_delay=1)
+        self.assertFalse(pacer.check_message('Connection reset by peer. Retrying (1/10)...'))
+        self.assertEqual(pacer.retry_sleep(n=0), 0)
+        self.assertTrue(pacer.check_message('HTTP Error 429: Too Many Requests. Retrying (1/10)...'))
+        self.assertGreater(pacer.retry_sleep(n=0), 0)
+
+    def test_token_bucket(self):
+        now = [0.0]
+        pacer = Pacer(rate=1, burst=2, clock=lambda: now[0])
+        pacer.bucket.take(); pacer.bucket.take()
+        self.assertAlmostEqual(pacer.bucket.delay(), 1.0)
+        now[0] += 0.5
+        self.assertAlmostEqual(pacer.bucket.delay(), 0.5)
+
+    def test_fetch_extractor_error(self):
+        class Downloader:
+            def extract_info(self, url, download, process):
+                return None # what yt-dlp returns with `ignoreerrors`
+            def process_ie_result(self, info, download, extra_info):
+                raise AssertionError('processed a failed extraction')
+        pacer = Pacer(rate=1, burst=2, clock=lambda: 0.0)
+        mm = ytmm.YoutubeMM('music.json', pacer=pacer)
+        with self.assertRaises(RuntimeError):
+            mm._fetch(Downloader(), 'https://youtu.be/badbadbad00', {})
+        # No media token spent
+        self.assertEqual(pacer.bucket.tokens, 1)
+
+    def test_metadata_priority(self):
+        pacer = Pacer(rate=0, base_delay=0.1)
+        pacer.throttled()
+        order = []
+        def run(priority):
+            pacer.acquire(priority)
+            order.append(priority)
+        media = threading.Thread(target=run, args=(MEDIA,))
+        media.start()
+        metadata = threading.Thread(target=run, args=(METADATA,))
+        metadata.start()
+        media.join(); metadata.join()
+        self.assertEqual(order, [METADATA, MEDIA])
+
+
+def _entry(id, title, artists=('someone',)):
+    return {'id': id, 'title': title, 'artists': list(artists)}
+
+
+class TempDirTestCase(unittest.TestCase):
+    """Runs every test in its own temporary working directory"""
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.dir.name)
+        self.addCleanup(os.chdir, cwd)
+
+    def setenv(self, var: str, value: str | None):
+        old = os.environ.get(var)
+        self.addCleanup(lambda: os.environ.pop(var, None) if old is None else os.environ.update({var: old}))
+        if value is None:
+            os.environ.pop(var, None)
+        else:
+            os.environ[var] = value
+
+
+class TestUtils(unittest.TestCase):
+    def test_video_id_from_url(self):
+        self.assertEqual(video_id_from_url('https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=1'), 'dQw4w9WgXcQ')
+        self.assertEqual(video_id_from_url('https://youtu.be/dQw4w9WgXcQ'), 'dQw4w9WgXcQ')
+        self.assertEqual(video_id_from_url('dQw4w9WgXcQ'), 'dQw4w9WgXcQ')
+        self.assertIsNone(video_id_from_url('https://www.youtube.com/playlist?list=PL0123456789'))
+
+
+class TestShards(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        entries = [_entry('aaaaaaaaaaa', 'one'), _entry('bbbbbbbbbbb', 'two'), _entry('Ccccccccccc', 'three')]
+        with open('music.json', 'w') as f:
+            json.dump({'root': 'music', 'data': entries}, f)
+        with ytmm.YoutubeMM() as mm:
+            mm.shard('id')
+
+    def test_manifest_and_shards(self):
+        with open('music.json') as f:
+            manifest = json.load(f)
+        self.assertNotIn('data', manifest)
+        self.assertEqual(list(manifest['index']), ['aaaaaaaaaaa', 'bbbbbbbbbbb', 'Ccccccccccc'])
+        self.assertEqual(sorted(os.listdir('music.d')), ['a.json', 'b.json', 'c_.json'])
+
+    def test_lazy_load(self):
+        with ytmm.YoutubeMM() as mm:
+            self.assertIn('bbbbbbbbbbb', mm.ids())
+            self.assertEqual(mm.store.shards, {})
+            self.assertEqual(mm.get_entry('bbbbbbbbbbb')['title'], 'two')
+            self.assertEqual(list(mm.store.shards), ['b'])
+            self.assertEqual([e['title'] for e in mm.entries], ['one', 'two', 'three'])
+
+    def test_only_changed_shards_written(self):
+        store = ShardedStore('music.json', 'id', json.load(open('music.json'))['index'])
+        store.put(_entry('bbbbbbbbbbb', 'two (remastered)'))
+        self.assertEqual(store.save('music'), [os.path.join('music.d', 'b.json')])
+
+        with ytmm.YoutubeMM() as mm:
+            mm.entries = [e for e in mm.entries if e['id'] != 'aaaaaaaaaaa']
+            mm.store.replace_all(mm.entries)
+            self.assertEqual(mm.store.dirty, {'a'})
+            mm.modified = True
+        self.assertFalse(os.path.exists(os.path.join('music.d', 'a.json')))
+        with ytmm.YoutubeMM() as mm:
+            self.assertEqual([e['title'] for e in mm.entries], ['two (remastered)', 'three'])
+
+    def test_fingerprints_outside_manifest(self):
+        with ytmm.YoutubeMM() as mm:
+            mm.fingerprints.add('aaaaaaaaaaa', {'sha256': 'x', 'key': 'someone/one'})
+            mm.modified = True
+        with open('music.json') as f:
+            self.assertNotIn('fingerprints', json.load(f))
+        with ytmm.YoutubeMM() as mm:
+            self.assertIsNone(mm._fingerprints)
+            self.assertIn('aaaaaaaaaaa', mm.fingerprints.fingerprints)
+            mm.shard(None)
+        with open('music.json') as f:
+            self.assertIn('aaaaaaaaaaa', json.load(f)['fingerprints'])
+
+    def test_change_layout(self):
+        with ytmm.YoutubeMM() as mm:
+            mm.shard('artist')
+        self.assertEqual(os.listdir('music.d'), ['so.json'])
+        with ytmm.YoutubeMM() as mm:
+            self.assertEqual([e['title'] for e in mm.entries], ['one', 'two', 'three'])
+            mm.shard(None)
+        self.assertFalse(os.path.exists('music.d'))
+        with open('music.json') as f:
+            self.assertEqual(len(json.load(f)['data']), 3)
+
+
+class TestFindDatabase(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.home = os.path.realpath(self.dir.name)
+        self.setenv('XDG_CACHE_HOME', os.path.join(self.home, 'cache'))
+        self.setenv('YTMM_DB', None)
+
+        self.db = os.path.join(self.home, 'library', 'music.json')
+        os.makedirs(os.path.join(self.home, 'library', 'albums', 'deep'))
+        with open(self.db, 'w') as f:
+            json.dump({'root': 'music', 'data': []}, f)
+
+    def test_upward_search_and_cache(self):
+        os.chdir(os.path.join(self.home, 'library', 'albums', 'deep'))
+        base = os.path.join(self.home, 'library')
+        self.assertEqual(find_database(), (self.db, base))
+        with open(location_cache_file()) as f:
+            self.assertEqual(json.load(f), {os.getcwd(): [self.db, base]})
+
+        with ytmm.YoutubeMM() as mm:
+            self.assertEqual(mm.root, os.path.join(base, 'music'))
+            self.assertEqual(mm._stored_root(), 'music')
+
+    def test_stale_cache(self):
+        os.chdir(os.path.join(self.home, 'library', 'albums'))
+        find_database()
+        os.remove(self.db)
+        self.assertEqual(find_database(), ('music.json', ''))
+
+    def test_subdirectory(self):
+        os.chdir(self.home)
+        self.assertEqual(find_database(), (self.db, ''))
+
+    def test_override(self):
+        os.chdir(self.home)
+        self.assertEqual(find_database('other/music.json'), ('other/music.json', 'other'))
+        os.environ['YTMM_DB'] = self.db
+        self.assertEqual(find_database(), (self.db, os.path.dirname(self.db)))
+
+
+class TestServer(TempDirTestCase):
+    def setUp(self):
+        from ytmm.server import Server
+        super().setUp()
+        self.setenv('XDG_RUNTIME_DIR', self.dir.name)
+
+        os.mkdir('music')
+        open(os.path.join('music', 'one.mp3'), 'w').close()
+        with open('music.json', 'w') as f:
+            json.dump({'root': 'music', 'data': [_entry('aaaaaaaaaaa', 'one'), _entry('bbbbbbbbbbb', 'two')]}, f)
+
+        self.mm = ytmm.YoutubeMM('music.json').__enter__()
+        self.server = Server(self.mm, client.socket_path('music.json'))
+        thread = threading.Thread(target=self.server.serve, args=(60,), daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def request(self, *argv, prompt=None):
+        out = io.StringIO()
+        return client.request('music.json', list(argv), out, prompt), out.getvalue()
+
+    def test_query(self):
+        status, out = self.request('query', '-F', '--downloaded')
+        self.assertEqual(status, 0)
+        self.assertEqual(out.split(), [os.path.join('music', 'one.mp3')])
+
+        open(os.path.join('music', 'two.mp3'), 'w').close()
+        status, out = self.request('query', '-n')
+        self.assertEqual(out.split()[-3:], ['2', '2', '0'])
+
+    def test_reload_after_external_write(self):
+        with open('music.json', 'w') as f:
+            json.dump({'root': 'music', 'data': [_entry('ccccccccccc', 'three')]}, f)
+        os.utime('music.json', ns=(0, 0))
+        status, out = self.request('query', '-T', 'three')
+        self.assertIn('ccccccccccc', out)
+
+    def test_own_writes_not_reloaded(self):
+        loads = []
+        self.mm.load = lambda: loads.append(1)
+        os.utime('music.json', ns=(0, 0))
+        self.mm.save_to('music.json', quiet=True) # e.g. a checkpoint
+        self.server.reload_if_changed()
+        self.assertEqual(loads, [])
+        os.utime('music.json', ns=(0, 0))
+        self.server.reload_if_changed()
+        self.assertEqual(loads, [1])
+
+    def test_prompts_forwarded(self):
+        open(os.path.join('music', 'stray.txt'), 'w').close()
+        questions = []
+        def prompt(kind, question):
+            questions.append((kind, question))
+            return kind == 'confirm'
+        status, out = self.request('sync', prompt=prompt)
+        self.assertEqual(status, 0)
+        self.assertEqual([kind for kind, _ in questions], ['confirm', 'ask'])
+        self.assertIn('Proceed to download?', questions[1][1])
+        self.assertFalse(os.path.exists(os.path.join('music', 'stray.txt')))
+
+    def test_private_socket_dir(self):
+        os.chmod(client.socket_dir(), 0o755)
+        with self.assertRaises(PermissionError):
+            client.socket_path('music.json')
+        self.assertEqual(self.request('query'), (None, ''))
+
+    def test_empty_request_ignored(self):
+        errors = []
+        self.server.handle_error = lambda request, address: errors.append(address)
+        for data in (b'', b'not json\n', b'[]\n'):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(client.socket_path('music.json'))
+                sock.sendall(data)
+        self.assertEqual(self.request('query', '-n')[0], 0)
+        self.assertEqual(errors, [])
+
+    def test_local_commands_refused(self):
+        self.assertEqual(self.request('rm', 'one'), (None, ''))
+        self.assertIsNone(client.request('other.json', ['query']))
+
+
+def _mp3(path, audio, tag=b''):
+    # ID3v2 header (syncsafe size) followed by "audio" frames
+    header = b'ID3\x04\x00\x00' + bytes([0, 0, 0, len(tag)])
+    with open(path, 'wb') as f:
+        f.write(header + tag + audio)
+
+
+class TestDedupe(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+
+    def test_content_hash_ignores_tags(self):
+        _mp3('a.mp3', b'\xff\xfb' * 100, b'title one')
+        _mp3('b.mp3', b'\xff\xfb' * 100, b'another title')
+        _mp3('c.mp3', b'\xff\xfa' * 100, b'title one')
+        self.assertEqual(content_hash('a.mp3'), content_hash('b.mp3'))
+        self.assertNotEqual(content_hash('a.mp3'), content_hash('c.mp3'))
+
+    def test_index_match(self):
+        index = FingerprintIndex({'aaaaaaaaaaa': {'sha256': 'x', 'key': 'someone/song', 'duration': 200.0}})
+        self.assertEqual(index.match('bbbbbbbbbbb', {'sha256': 'x', 'key': 'other'}), ('aaaaaaaaaaa', 'content'))
+        self.assertEqual(index.match('bbbbbbbbbbb', {'sha256': 'y', 'key': 'someone/song', 'duration': 201.5}), ('aaaaaaaaaaa', 'title'))
+        self.assertIsNone(index.match('bbbbbbbbbbb', {'sha256': 'y', 'key': 'someone/song', 'duration': 260.0}))
+        self.assertIsNone(index.match('aaaaaaaaaaa', {'sha256': 'x', 'key': 'someone/song'}))
+        self.assertEqual(title_key(_entry('a', 'Song (Official Video)', ['Someone'])), 'someone/song')
+
+    def test_dedupe_links_duplicates(self):
+        os.mkdir('music')
+        _mp3(os.path.join('music', 'song.mp3'), b'\xff\xfb' * 1000, b'official')
+        _mp3(os.path.join('music', 'song_lyrics.mp3'), b'\xff\xfb' * 1000, b'lyrics')
+        _mp3(os.path.join('music', 'other.mp3'), b'\xff\xfa' * 1000)
+        entries = [_entry('aaaaaaaaaaa', 'Song'), _entry('bbbbbbbbbbb', 'Song Lyrics'), _entry('ccccccccccc', 'Other')]
+        with open('music.json', 'w') as f:
+            json.dump({'root': 'music', 'data': entries}, f)
+
+        out = io.StringIO()
+        with use_console(Console(file=out, width=200), interactive=False), ytmm.YoutubeMM('music.json') as mm:
+            mm.dedupe()
+        self.assertIn('1 duplicate(s), reclaims 2.0 kB', out.getvalue())
+        self.assertEqual(sorted(os.listdir('music')), ['other.mp3', 'song.mp3'])
+
+        with open('music.json') as f:
+            db = json.load(f)
+        self.assertEqual(db['data'][1]['link'], 'aaaaaaaaaaa')
+        self.assertEqual(sorted(db['fingerprints']), ['aaaaaaaaaaa', 'ccccccccccc'])
+        with ytmm.YoutubeMM('music.json') as mm:
+            self.assertTrue(mm.is_downloaded(mm.entries[1]))
+
+    def test_link_removes_every_variant(self):
+        for root, ext in (('music', 'mp3'), ('music-phone', 'opus')):
+            os.mkdir(root)
+            _mp3(os.path.join(root, f'song.{ext}'), b'\xff\xfb' * 1000)
+            _mp3(os.path.join(root, f'song_lyrics.{ext}'), b'\xff\xfb' * 1000)
+        entries = [_entry('aaaaaaaaaaa', 'Song'), _entry('bbbbbbbbbbb', 'Song Lyrics')]
+        for entry in entries:
+            entry['variants'] = ['default', 'phone']
+        with open('music.json', 'w') as f:
+            json.dump({'root': 'music', 'data': entries}, f)
+
+        with use_console(Console(file=io.StringIO()), interactive=False), ytmm.YoutubeMM('music.json') as mm:
+            mm.dedupe()
+        self.assertEqual(os.listdir('music-phone'), ['song.opus'])
+        with open('music.json') as f:
+            self.assertEqual(json.load(f)['data'][1], {**_entry('bbbbbbbbbbb', 'Song Lyrics'), 'link': 'aaaaaaaaaaa'})
+
+    def test_remove_hands_file_to_dependents(self):
+        os.mkdir('music')
+        _mp3(os.path.join('music', 'song.mp3'), b'\xff\xfb' * 1000)
+        entries = [_entry('aaaaaaaaaaa', 'Song'), _entry('bbbbbbbbbbb', 'Song Lyrics'), _entry('ccccccccccc', 'Song Live')]
+        entries[1]['link'] = entries[2]['link'] = 'aaaaaaaaaaa'
+        with open('music.json', 'w') as f:
+            json.dump({'root': 'music', 'data': entries, 'fingerprints': {'aaaaaaaaaaa': {'sha256': 'x', 'key': 'someone/song'}}}, f)
+
+        with use_console(Console(file=io.StringIO()), interactive=False), ytmm.YoutubeMM('music.json') as mm:
+            mm.remove('^Song$', None)
+        self.assertEqual(os.listdir('music'), ['song_lyrics.mp3'])
+        with open('music.json') as f:
+            db = json.load(f)
+        self.assertEqual(db['data'], [_entry('bbbbbbbbbbb', 'Song Lyrics'), {**_entry('ccccccccccc', 'Song Live'), 'link': 'bbbbbbbbbbb'}])
+        self.assertEqual(db['fingerprints'], {'bbbbbbbbbbb': {'sha256': 'x', 'key': 'someone/song_lyrics'}})
+
+
+class TestAddCheckpoints(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        os.mkdir('music')
+        self.broken = {'https://youtu.be/badbadbad00'}
+        self.saved = [] # entries in the database file when each download starts
+
+    def fetch(self, d, url, extra_info):
+        with open('music.json') as f:
+            self.saved.append(len(json.load(f)['data']))
+        if url in self.broken:
+            raise RuntimeError('Video unavailable')
+        id = url[-11:]
+        os.makedirs('cache', exist_ok=True)
+        _mp3(os.path.join('cache', f'{id}.webm'), id.encode() * 10)
+        return {'id': id, 'title': f'Someone - Song {id}', 'requested_downloads': [{'filepath': os.path.join('cache', f'{id}.webm')}]}
+
+    def add(self, urls, **kwargs):
+        with use_console(Console(file=io.StringIO()), interactive=False), ytmm.YoutubeMM('music.json') as mm:
+            mm._fetch = self.fetch
+            mm._transcode = lambda source, path, profile, metadata: shutil.copy(source, path)
+            mm.sources = SourceCache('cache')
+            mm.sources.scan = lambda: self.fail('source cache rescanned after a download')
+            mm.checkpoint_every = 2
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as mm.executor:
+                mm.add(urls, **kwargs)
+        with open('music.json') as f:
+            return json.load(f)
+
+    def test_checkpoints_and_retry(self):
+        with open('music.json', 'w') as f:
+            json.dump({'root': 'music', 'data': []}, f)
+        urls = [f'https://youtu.be/song{i}song{i}1' for i in range(2)] + ['https://youtu.be/badbadbad00'] + [f'https://youtu.be/song{i}song{i}1' for i in range(2, 5)]
+        db = self.add(urls)
+
+        # Written after every second success, failures do not count
+        self.assertEqual(self.saved, [0, 0, 2, 2, 2, 4])
+        self.assertEqual(len(db['data']), 5)
+        self.assertEqual(db['failed'], {'https://youtu.be/badbadbad00': {'error': 'Video unavailable', 'attempts': 1}})
+        # No temporary files left behind by atomic writes
+        self.assertEqual(sorted(os.listdir('.')), ['cache', 'music', 'music.json'])
+
+        self.broken.clear()
+        db = self.add([], retry_failed=True)
+        self.assertEqual(len(db['data']), 6)
+        self.assertNotIn('failed', db)
+
+
+class TestProfiling(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+
+    def test_spans(self):
+        spans = ytmm.Spans()
+        with use_console(Console(file=io.StringIO()), interactive=False):
+            with ytmm.YoutubeMM('music.json', spans=spans) as mm:
+                mm.query()
+        self.assertEqual([r.name for r in spans.records], ['load', 'plan', 'execute', 'save'])
+
+        spans.clear()
+        with spans.phases():
+            spans.phase('outer')
+            with spans.phases():
+                spans.phase('inner')
+        self.assertEqual([r.name for r in spans.records], ['inner', 'outer'])
+
+        spans = ytmm.Spans(max_records=2)
+        for name in ('a', 'b', 'c'):
+            with spans.span(name): pass
+        self.assertEqual([r.name for r in spans.records], ['b', 'c'])
+
+    def test_profile_output(self):
+        import pstats
+        with ytmm.profile('cprofile', 'out.prof'):
+            sorted(range(1000))
+        self.assertTrue(pstats.Stats('out.prof').total_calls > 0)
+
+        with ytmm.profile('sampling', 'out.folded'):
+            time.sleep(0.1)
+        with open('out.folded') as f:
+            self.assertIn('test_profile_output', f.read())
+
+
+class TestOutputProfiles(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+
+    def test_load_profiles(self):
+        profiles = load_profiles({'car': {'codec': 'aac', 'ext': 'm4a', 'bitrate': '128k'}})
+        self.assertEqual(profiles['car'].codec_args(), ['-c:a', 'aac', '-b:a', '128k'])
+        self.assertEqual(profiles['default'].codec_args(), ['-c:a', 'libmp3lame', '-q:a', '5'])
+        self.assertEqual(profiles['archive'].codec_args(), ['-c:a', 'copy'])
+        with self.assertRaises(ValueError):
+            OutputProfile('bad', 'wav', 'wav')
+
+    def test_source_cache_eviction(self):
+        cache = SourceCache('cache', max_bytes=25)
+        os.mkdir('cache')
+        for i, id in enumerate(['a', 'b', 'c']):
+            with open(os.path.join('cache', f'{id}.webm'), 'wb') as f:
+                f.write(b'x' * 10)
+            os.utime(os.path.join('cache', f'{id}.webm'), (1000 + i, 1000 + i))
+        with open(os.path.join('cache', 'd.webm.part'), 'wb') as f:
+            f.write(b'x' * 100)
+
+        self.assertIsNone(cache.find('d'))
+        # Lookups do not count as use, transcoding does
+        self.assertEqual(os.path.getmtime(cache.find('b')), 1001)
+        cache.touch(cache.find('a'))
+        self.assertEqual(cache.evict(), [os.path.join('cache', 'b.webm')])
+        self.assertEqual(sorted(os.listdir('cache')), ['a.webm', 'c.webm', 'd.webm.part'])
+
+    def test_sync_transcodes_cached_source(self):
+        with open('music.json', 'w') as f:
+            json.dump({'root': 'music', 'data': [{'id': 'abcdefghijk', 'title': 'Someone - Song', 'artists': ['Someone']}]}, f)
+        os.mkdir('cache')
+        _mp3(os.path.join('cache', 'abcdefghijk.webm'), b'audio')
+
+        def fetch(d, url, extra_info):
+            raise AssertionError('cached source downloaded again')
+        made = []
+        def transcode(source, path, profile, metadata):
+            made.append((profile.name, metadata['artist']))
+            shutil.copy(source, path)
+
+        with use_console(Console(file=io.StringIO()), interactive=False), ytmm.YoutubeMM('music.json') as mm:
+            mm._fetch = fetch
+            mm._transcode = transcode
+            mm.sources = SourceCache('cache')
+            mm.sync(None, None, None, ['default', 'phone'])
+            self.assertTrue(os.path.isfile(os.path.join('music', 'someone_song.mp3')))
+            self.assertTrue(os.path.isfile(os.path.join('music-phone', 'someone_song.opus')))
+            self.assertEqual(sorted(made), [('default', 'Someone'), ('phone', 'Someone')])
+
+            # Nothing left to make
+            made.clear()
+            mm.sync(None, None, None, ['phone'])
+            self.assertEqual(made, [])
+        with open('music.json') as f:
+            self.assertEqual(json.load(f)['data'][0]['variants'], ['default', 'phone'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,16 @@
 from .cli import main
-from .ytmm import YoutubeMM
+from .profiling import Spans, profile
 
 __all__ = [
     'main',
     'YoutubeMM',
+    'Spans',
+    'profile',
 ]
+
+def __getattr__(name):
+    # Imported lazily, so the CLI can talk to `ytmm serve` without loading yt-dlp
+    if name == 'YoutubeMM':
+        from .ytmm import YoutubeMM
+        return YoutubeMM
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,7 +1,14 @@
 import argparse
 import logging
-import sys
-from .ytmm import YoutubeMM
+import os, socket, sys
+from contextlib import nullcontext
+from .pacing import Pacer
+from .profiling import PROFILERS, DEFAULT_PROFILER, Spans, profile, default_output
+from .locate import find_database
+from . import client
+
+# Commands a running `ytmm serve` answers, everything else runs locally
+SERVED_COMMANDS = ('query', 'add', 'sync')
 
 def create_parser():
     def add_filters(parser):
@@ -10,11 +17,18 @@ def create_parser():
         parser.add_argument('-A', '--artist', metavar='PATTERN', help='pattern to filter by music artist')
 
     parser = argparse.ArgumentParser(description="YouTube Music Manager (v0.2.0)")
+    parser.add_argument('--db', metavar='PATH', default=None, help='database file (default: $YTMM_DB or search for music.json)')
+    parser.add_argument('--local', action='store_true', help='do not use a running `ytmm serve`')
+    parser.add_argument('--profile', action='store_true', help='profile the command')
+    parser.add_argument('--profiler', choices=PROFILERS, default=DEFAULT_PROFILER, help='profiler used by --profile (sampling sees all threads, cprofile is exact for the main thread only)')
+    parser.add_argument('--profile-output', metavar='PATH', help='profile file (default: ytmm-SUBCOMMAND.prof/.folded)')
+    parser.add_argument('--item-rate', type=float, default=2.0, metavar='N', help='max items started per second by all downloads (0 = unlimited), fragments and extractor requests of an item are not limited')
     subparsers = parser.add_subparsers(metavar="SUBCOMMAND", dest='command')
 
     # Sync command
     sync_parser = subparsers.add_parser('sync', help='sync from database to directory')
     sync_parser.add_argument('-o', '--output', type=str, default=None, help='Output directory')
+    sync_parser.add_argument('-p', '--output-profile', metavar='NAME', action='append', dest='profiles', help='output profile to make, can be repeated (default: default, see `ytmm profiles`)')
     add_filters(sync_parser)
 
     # Query command
@@ -29,6 +43,7 @@ def create_parser():
     # Add command
     add_parser = subparsers.add_parser('add', help='add YouTube URL to database')
     add_parser.add_argument('urls', nargs='*', help='youTube URLs to add')
+    add_parser.add_argument('--retry-failed', action='store_true', help='also add URLs that failed last time')
     #add_parser.add_argument('-t', '--title', help='override Music Title')
     #add_parser.add_argument('-a', '--artists', help='override Artists (Comma-separated list)')
 
@@ -38,37 +53,81 @@ def create_parser():
     remove_parser.add_argument('-A', '--artist', metavar='PATTERN', help='pattern to filter by music artist')
     remove_parser.add_argument('pattern',  metavar='PATTERN', help='pattern to filter by music title')
 
+    # Shard command
+    shard_parser = subparsers.add_parser('shard', help='split database into shards that load on demand')
+    shard_parser.add_argument('--by', choices=['id', 'artist', 'none'], default='id', help='how to split entries (none = single file)')
+
+    # Profiles command
+    subparsers.add_parser('profiles', help='list output profiles')
+
+    # Dedupe command
+    subparsers.add_parser('dedupe', help='find music with the same audio and link duplicates to one file (different uploads of a song are only recognized with fpcalc installed)')
+
+    # Serve command
+    serve_parser = subparsers.add_parser('serve', help='keep the database loaded and answer other ytmm commands')
+    serve_parser.add_argument('--rescan', type=float, default=60.0, metavar='SECONDS', help='interval between full rescans of the root directory')
+
     return parser
 
+def run(ytmm, args):
+    if args.command == 'sync':
+        title_pattern  = '(?i)' + args.title  if args.title  and args.i else args.title
+        artist_pattern = '(?i)' + args.artist if args.artist and args.i else args.artist
+        ytmm.sync(args.output, title_pattern, artist_pattern, args.profiles)
+    elif args.command == 'add':
+        #title = args.title
+        #artists = [s.strip() for s in args.artists.split(',')] if args.artists else None
+        ytmm.add(args.urls, args.retry_failed)
+    elif args.command == 'query':
+        title_pattern  = '(?i)' + args.title  if args.title  and args.i else args.title
+        artist_pattern = '(?i)' + args.artist if args.artist and args.i else args.artist
+        def list_filter(entries):
+            if args.last:  return entries[-args.last:]
+            if args.first: return entries[:args.first]
+            return entries
+        if args.count:
+            ytmm.count()
+        else:
+            ytmm.query(title_pattern, artist_pattern, args.downloaded, args.files, list_filter)
+    elif args.command == 'rm':
+        pattern        = '(?i)' + args.pattern if args.i else args.pattern
+        artist_pattern = '(?i)' + args.artist  if args.artist and args.i else args.artist
+        ytmm.remove(pattern, artist_pattern)
+    elif args.command == 'shard':
+        ytmm.shard(None if args.by == 'none' else args.by)
+    elif args.command == 'dedupe':
+        ytmm.dedupe()
+    elif args.command == 'profiles':
+        ytmm.show_profiles()
+
 def main():
     sys.stdout.reconfigure(encoding='utf-8')
-    logging.basicConfig(stream=sys.stdout)
     parser = create_parser()
     args = parser.parse_args()
-    if args.command != None:
-        with YoutubeMM() as ytmm:
-            if args.command == 'sync':
-                title_pattern  = '(?i)' + args.title  if args.title  and args.i else args.title
-                artist_pattern = '(?i)' + args.artist if args.artist and args.i else args.artist
-                ytmm.sync(args.output, title_pattern, artist_pattern)
-            elif args.command == 'add':
-                #title = args.title
-                #artists = [s.strip() for s in args.artists.split(',')] if args.artists else None
-                ytmm.add(args.urls)
-            elif args.command == 'query':
-                title_pattern  = '(?i)' + args.title  if args.title  and args.i else args.title
-                artist_pattern = '(?i)' + args.artist if args.artist and args.i else args.artist
-                def list_filter(entries):
-                    if args.last:  return entries[-args.last:]
-                    if args.first: return entries[:args.first]
-                    return entries
-                if args.count:
-                    ytmm.count()
-                else:
-                    ytmm.query(title_pattern, artist_pattern, args.downloaded, args.files, list_filter)
-            elif args.command == 'rm':
-                pattern        = '(?i)' + args.pattern if args.i else args.pattern
-                artist_pattern = '(?i)' + args.artist  if args.artist and args.i else args.artist
-                ytmm.remove(pattern, artist_pattern)
+    if args.command in SERVED_COMMANDS and not (args.local or args.profile):
+        database, _ = find_database(args.db)
+        status = client.request(database, sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
+
+    logging.basicConfig(stream=sys.stdout)
+    if args.command == 'serve':
+        if not hasattr(socket, 'AF_UNIX') or not hasattr(os, 'getuid'):
+            from .ytmm import output
+            output.error('ytmm serve needs Unix sockets, not available on this platform')
+            sys.exit(1)
+        from .server import serve
+        serve(args.db, args.rescan, Pacer(rate=args.item_rate))
+    elif args.command != None:
+        spans = Spans()
+        profile_output = args.profile_output or default_output(args.profiler, args.command)
+        with profile(args.profiler, profile_output) if args.profile else nullcontext():
+            from .ytmm import YoutubeMM
+            with YoutubeMM(args.db, pacer=Pacer(rate=args.item_rate), spans=spans) as ytmm:
+                run(ytmm, args)
+        if args.profile:
+            from .ytmm import output
+            output.section('Profile written to', output.path(profile_output))
+            output.status(*(f'{name} [b]{seconds*1000:.1f}[/]ms' for name, seconds in spans.totals().items()))
     else:
         parser.print_usage()
@@ -0,0 +1,85 @@
+import hashlib, json, os, shutil, socket, stat, sys, tempfile
+
+"""
+Protocol (one JSON object per line):
+
+client -> server:
+    {'argv': list[str], 'cwd': str, 'database': str, 'width': int, 'terminal': bool}
+
+server -> client:
+    {'out': str}                      (any number of times)
+    {'ask': str, 'question': str}     (kind of `prompts.ask`, client replies {'answer': bool | str})
+    {'status': int}                   (last message, null if the server refused the command)
+"""
+
+def socket_dir() -> str:
+    """Directory of the server sockets, only the current user may use it"""
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    path = os.path.join(runtime, 'ytmm') if runtime else os.path.join(tempfile.gettempdir(), f'ytmm-{os.getuid()}')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f'{path} is not a private directory')
+    return path
+
+
+def socket_path(database_file: str) -> str:
+    digest = hashlib.sha1(os.path.abspath(database_file).encode()).hexdigest()[:12]
+    return os.path.join(socket_dir(), f'ytmm-{digest}.sock')
+
+
+def _ask(out):
+    def ask(kind: str, question: str):
+        from rich.console import Console
+        from .prompts import ask
+        return ask(kind, question, Console(file=out, highlight=False))
+    return ask
+
+
+def request(database_file: str, argv: list, out=None, prompt=None) -> int | None:
+    """
+    Run a command on a running `ytmm serve`, returns None if there is no server to run it.
+    Questions of the command go to `prompt(kind, question)` (default: ask on `out`).
+    """
+    out = out or sys.stdout
+    prompt = prompt or _ask(out)
+    if not hasattr(socket, 'AF_UNIX') or not hasattr(os, 'getuid'):
+        return None
+    try:
+        path = socket_path(database_file)
+        # Somebody else's socket could answer in our name
+        if os.stat(path).st_uid != os.getuid():
+            return None
+    except OSError:
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock, sock.makefile('rwb') as f:
+        f.write(json.dumps({
+            'argv':     argv,
+            'cwd':      os.getcwd(),
+            'database': os.path.abspath(database_file),
+            'width':    shutil.get_terminal_size().columns,
+            'terminal': out.isatty(),
+        }).encode() + b'\n')
+        f.flush()
+
+        for line in f:
+            message = json.loads(line)
+            if 'out' in message:
+                out.write(message['out'])
+                out.flush()
+            elif 'ask' in message:
+                answer = prompt(message['ask'], message['question'])
+                f.write(json.dumps({'answer': answer}).encode() + b'\n')
+                f.flush()
+            elif 'status' in message:
+                return message['status']
+    # Server went away before finishing
+    return 1
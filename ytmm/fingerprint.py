@@ -0,0 +1,156 @@
+import base64, hashlib, json, os, shutil, struct, subprocess
+from .utils import file_name_from_title
+
+"""
+Fingerprint (stored in the database under 'fingerprints', by entry id):
+    'sha256':      str,    hash of the audio data (tags excluded)
+    'key':         str,    normalized "artist/title"
+    'duration':    float,  [optional] seconds
+    'chromaprint': str,    [optional] base64 of the raw fingerprint (needs `fpcalc`)
+"""
+
+DURATION_TOLERANCE = 2.0  # seconds
+MIN_SIMILARITY     = 0.9  # fraction of equal chromaprint bits
+CHROMAPRINT_LENGTH = 30   # seconds of audio to fingerprint
+
+
+def _audio_range(f, size: int) -> tuple[int, int]:
+    # Skip ID3v2 header and ID3v1 trailer, these differ between uploads of the same audio
+    start, end = 0, size
+    header = f.read(10)
+    if len(header) == 10 and header[:3] == b'ID3':
+        start = 10 + ((header[6] & 0x7f) << 21 | (header[7] & 0x7f) << 14 | (header[8] & 0x7f) << 7 | (header[9] & 0x7f))
+    if size >= 128:
+        f.seek(size - 128)
+        if f.read(3) == b'TAG':
+            end = size - 128
+    return min(start, end), end
+
+
+def content_hash(path: str) -> str:
+    # Only equal for byte identical audio (e.g. the same stream uploaded twice),
+    # other uploads of a song are encoded differently and need `chromaprint`
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        start, end = _audio_range(f, os.path.getsize(path))
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1<<20))
+            if not chunk: break
+            h.update(chunk)
+            remaining -= len(chunk)
+    return h.hexdigest()
+
+
+def title_key(entry: dict) -> str:
+    artist = entry['artists'][0] if entry.get('artists') else ''
+    return f"{file_name_from_title(artist)}/{file_name_from_title(entry['title'])}"
+
+
+def probe_duration(path: str) -> float | None:
+    if not shutil.which('ffprobe'):
+        return None
+    try:
+        result = subprocess.run (
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path],
+            capture_output=True, text=True, check=True
+        )
+        return float(result.stdout.strip())
+    except (subprocess.SubprocessError, ValueError):
+        return None
+
+
+def has_chromaprint() -> bool:
+    return shutil.which('fpcalc') is not None
+
+
+def chromaprint(path: str) -> str | None:
+    if not has_chromaprint():
+        return None
+    try:
+        result = subprocess.run (
+            ['fpcalc', '-raw', '-json', '-length', str(CHROMAPRINT_LENGTH), path],
+            capture_output=True, text=True, check=True
+        )
+        raw = json.loads(result.stdout)['fingerprint']
+    except (subprocess.SubprocessError, ValueError, KeyError):
+        return None
+    return base64.b64encode(struct.pack(f'<{len(raw)}I', *(x & 0xffffffff for x in raw))).decode()
+
+
+def _unpack(fp: str) -> tuple:
+    data = base64.b64decode(fp)
+    return struct.unpack(f'<{len(data)//4}I', data)
+
+
+def similarity(a: str, b: str, max_offset: int = 8) -> float:
+    """Fraction of equal bits between two chromaprints, best over small alignment offsets"""
+    a, b = _unpack(a), _unpack(b)
+    best = 0.0
+    for offset in range(-max_offset, max_offset+1):
+        pairs = list(zip(a[max(offset,0):], b[max(-offset,0):]))
+        if not pairs: continue
+        differing = sum((x ^ y).bit_count() for x, y in pairs)
+        best = max(best, 1 - differing / (32*len(pairs)))
+    return best
+
+
+def fingerprint(path: str, entry: dict, duration: float | None = None) -> dict:
+    fp = {'sha256': content_hash(path), 'key': title_key(entry)}
+    duration = duration or probe_duration(path)
+    if duration:
+        fp['duration'] = float(duration)
+    acoustic = chromaprint(path)
+    if acoustic:
+        fp['chromaprint'] = acoustic
+    return fp
+
+
+class FingerprintIndex:
+    def __init__(self, fingerprints: dict | None = None):
+        self.fingerprints = {}
+        self.by_hash = {}
+        self.by_key  = {}
+        self.version = 0 # changes with every add/remove
+        for id, fp in (fingerprints or {}).items():
+            self.add(id, fp)
+        self.version = 0
+
+    def add(self, id: str, fp: dict):
+        self.remove(id)
+        self.fingerprints[id] = fp
+        self.version += 1
+        self.by_hash.setdefault(fp['sha256'], id)
+        self.by_key.setdefault(fp['key'], []).append(id)
+
+    def remove(self, id: str):
+        fp = self.fingerprints.pop(id, None)
+        if fp is None:
+            return
+        self.version += 1
+        if self.by_hash.get(fp['sha256']) == id:
+            del self.by_hash[fp['sha256']]
+        self.by_key[fp['key']].remove(id)
+
+    def match(self, id: str, fp: dict) -> tuple[str, str] | None:
+        """Returns `(id, reason)` of an indexed duplicate of `fp`, ignoring `id` itself"""
+        other = self.by_hash.get(fp['sha256'])
+        if other is not None and other != id:
+            return other, 'content'
+
+        def close(other_fp):
+            a, b = fp.get('duration'), other_fp.get('duration')
+            return a is not None and b is not None and abs(a - b) <= DURATION_TOLERANCE
+
+        for other in self.by_key.get(fp['key'], []):
+            if other != id and close(self.fingerprints[other]):
+                return other, 'title'
+
+        if 'chromaprint' in fp:
+            for other, other_fp in self.fingerprints.items():
+                if other == id or 'chromaprint' not in other_fp or not close(other_fp):
+                    continue
+                if similarity(fp['chromaprint'], other_fp['chromaprint']) >= MIN_SIMILARITY:
+                    return other, 'acoustic'
+        return None
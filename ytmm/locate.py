@@ -0,0 +1,86 @@
+import json, os
+from .utils import write_json_atomic
+
+DEFAULT_DATABASE    = 'music.json'
+DEFAULT_ROOT        = 'music'
+DATABASE_ENV        = 'YTMM_DB'
+LOCATION_CACHE_SIZE = 256
+
+def cache_dir() -> str:
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'ytmm')
+
+def location_cache_file() -> str:
+    return os.path.join(cache_dir(), 'locations.json')
+
+def _read_location_cache() -> dict:
+    try:
+        with open(location_cache_file()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_location_cache(cwd: str, location: tuple[str, str]):
+    cache = _read_location_cache()
+    cache.pop(cwd, None)
+    cache[cwd] = list(location)
+    # Oldest entries are first, keep the cache small
+    cache = dict(list(cache.items())[-LOCATION_CACHE_SIZE:])
+    try:
+        file = location_cache_file()
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        # Many ytmm processes can run at once, none may see a partial file
+        write_json_atomic(file, cache)
+    except OSError:
+        pass
+
+def _scan_subdirectories() -> str | None:
+    # Legacy lookup: a database in any direct subdirectory
+    for entry in os.scandir('.'):
+        if entry.name == DEFAULT_ROOT or not entry.is_dir():
+            continue
+        path = os.path.join(entry.name, DEFAULT_DATABASE)
+        if os.path.isfile(path):
+            return path
+    return None
+
+def find_database(database: str | None = None) -> tuple[str, str]:
+    """
+    Locate the database file, returns `(file, base)` where `base` is the
+    directory relative roots are resolved from ('' for the working directory).
+
+    Order: explicit path, $YTMM_DB, working directory, cached location,
+    parent directories, direct subdirectories.
+    """
+    database = database or os.environ.get(DATABASE_ENV)
+    if database:
+        return database, os.path.dirname(database)
+
+    if os.path.isfile(DEFAULT_DATABASE):
+        return DEFAULT_DATABASE, ''
+
+    cwd = os.path.abspath('.')
+    cached = _read_location_cache().get(cwd)
+    if cached and os.path.isfile(cached[0]):
+        return tuple(cached)
+
+    location = None
+    parent = os.path.dirname(cwd)
+    while parent != cwd and location is None:
+        path = os.path.join(parent, DEFAULT_DATABASE)
+        if os.path.isfile(path):
+            location = (path, parent)
+        cwd, parent = parent, os.path.dirname(parent)
+
+    if location is None:
+        path = _scan_subdirectories()
+        if path is not None:
+            location = (path, '')
+
+    if location is None:
+        return DEFAULT_DATABASE, ''
+
+    # Subdirectory databases keep roots relative to the working directory (base = '')
+    location = (os.path.abspath(location[0]), location[1])
+    _write_location_cache(os.path.abspath('.'), location)
+    return location
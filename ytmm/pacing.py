@@ -0,0 +1,147 @@
+import threading, time
+from contextlib import contextmanager
+
+# Request priorities, lower value is served first
+METADATA = 0
+MEDIA    = 1
+
+# Messages from yt-dlp that mean we are being throttled
+THROTTLE_MARKERS = ('HTTP Error 429', 'Too Many Requests', 'HTTP Error 503')
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        self.rate     = rate
+        self.capacity = capacity
+        self.tokens   = capacity
+        self.clock    = clock
+        self.last     = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self) -> float:
+        """Seconds until a token is available (0 if one is available now)"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+class CircuitBreaker:
+    def __init__(self, base_delay: float, max_delay: float, clock=time.monotonic):
+        self.base_delay = base_delay
+        self.max_delay  = max_delay
+        self.clock      = clock
+        self.failures   = 0
+        self.open_until = 0.0
+
+    def remaining(self) -> float:
+        return max(0.0, self.open_until - self.clock())
+
+    def is_open(self) -> bool:
+        return self.remaining() > 0
+
+    def record_failure(self) -> float:
+        # Failures while already backing off come from the same throttling, count them once
+        if self.is_open():
+            return self.remaining()
+        self.failures += 1
+        delay = min(self.max_delay, self.base_delay * 2**(self.failures-1))
+        self.open_until = max(self.open_until, self.clock() + delay)
+        return delay
+
+    def record_success(self):
+        if not self.is_open():
+            self.failures = 0
+
+
+class Pacer:
+    """
+    Pacing shared by every download worker:
+        - token bucket limiting the rate items start at, each item takes one
+          metadata and one media token (`YoutubeMM._fetch`), the requests
+          yt-dlp makes for the item itself are not counted
+        - circuit breaker that pauses *all* workers with exponential backoff
+          when any of them gets throttled
+        - metadata requests are served before media requests
+    """
+    def __init__ (
+        self,
+        rate:       float = 2.0,
+        burst:      float = 4.0,
+        base_delay: float = 2.0,
+        max_delay:  float = 120.0,
+        clock = time.monotonic,
+    ):
+        self.bucket  = TokenBucket(rate, burst, clock)
+        self.breaker = CircuitBreaker(base_delay, max_delay, clock)
+        self.waiting = [0, 0]
+        self.listeners = []
+        self._cond = threading.Condition()
+
+    def acquire(self, priority: int = MEDIA):
+        with self._cond:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    if priority == MEDIA and self.waiting[METADATA]:
+                        self._cond.wait()
+                        continue
+                    delay = max(self.breaker.remaining(), self.bucket.delay())
+                    if delay <= 0:
+                        self.bucket.take()
+                        return
+                    self._cond.wait(delay)
+            finally:
+                self.waiting[priority] -= 1
+                self._cond.notify_all()
+
+    def throttled(self, reason: str = 'throttled') -> float:
+        with self._cond:
+            delay = self.breaker.record_failure()
+        self._notify(f'backing off {delay:.0f}s ({reason})')
+        return delay
+
+    def succeeded(self):
+        with self._cond:
+            was_failing = self.breaker.failures > 0
+            self.breaker.record_success()
+            recovered = was_failing and self.breaker.failures == 0
+        if recovered:
+            self._notify('')
+
+    def check_message(self, msg: str) -> bool:
+        for marker in THROTTLE_MARKERS:
+            if marker in msg:
+                self.throttled(marker)
+                return True
+        return False
+
+    def retry_sleep(self, n: int) -> float:
+        """
+        Used as yt-dlp `retry_sleep_functions`, retries wait for the breaker.
+        yt-dlp logs the error of a retry before sleeping, so throttling already
+        opened it (see `check_message`), other errors retry right away.
+        """
+        return self.breaker.remaining()
+
+    @contextmanager
+    def listen(self, listener):
+        self.listeners.append(listener)
+        try:
+            yield self
+        finally:
+            self.listeners.remove(listener)
+
+    def _notify(self, status: str):
+        for listener in self.listeners:
+            listener(status)
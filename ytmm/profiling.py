@@ -0,0 +1,154 @@
+import os, sys, threading, time
+from collections import Counter, deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+# Sampling sees every thread (downloads, transcodes and progress rendering run in pools),
+# cProfile either only sees the main thread or mixes the call stacks of all threads
+PROFILERS = ('sampling', 'cprofile')
+DEFAULT_PROFILER = 'sampling'
+SAMPLE_INTERVAL = 0.005 # seconds
+MAX_SPANS       = 10000 # oldest spans are dropped, `ytmm serve` records for its whole life
+
+
+@dataclass
+class Span:
+    name:     str
+    start:    float # time.perf_counter()
+    duration: float
+    thread:   str
+
+
+class Spans:
+    """
+    Timing of the phases of `YoutubeMM` commands (load, plan, execute, save).
+
+        with YoutubeMM() as mm:
+            mm.add(urls)
+        print(mm.spans.totals())
+    """
+    def __init__(self, max_records: int = MAX_SPANS):
+        self.records = deque(maxlen=max_records)
+        self.listeners = [] # called with every finished `Span`
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _record(self, name: str, start: float):
+        record = Span(name, start, time.perf_counter() - start, threading.current_thread().name)
+        with self._lock:
+            self.records.append(record)
+        for listener in self.listeners:
+            listener(record)
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, start)
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _close(self, stack: list):
+        if stack[-1] is not None:
+            self._record(*stack[-1])
+            stack[-1] = None
+
+    @contextmanager
+    def phases(self):
+        """Scope for `phase`, the last phase ends with it"""
+        stack = self._stack()
+        stack.append(None)
+        try:
+            yield
+        finally:
+            self._close(stack)
+            stack.pop()
+
+    def phase(self, name: str | None):
+        """End the current phase of this thread and start `name`"""
+        stack = self._stack()
+        if not stack:
+            return
+        self._close(stack)
+        if name is not None:
+            stack[-1] = (name, time.perf_counter())
+
+    def totals(self) -> dict:
+        totals = {}
+        with self._lock:
+            for record in self.records:
+                totals[record.name] = totals.get(record.name, 0.0) + record.duration
+        return totals
+
+    def clear(self):
+        with self._lock:
+            self.records.clear()
+
+
+class SamplingProfiler:
+    # Samples the stacks of all threads, written in the "folded" format flame graph tools read
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ytmm-sampler', daemon=True)
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me: continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump_stats(self, path: str):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+def default_output(kind: str, command: str | None) -> str:
+    suffix = 'prof' if kind == 'cprofile' else 'folded'
+    return f'ytmm-{command or "main"}.{suffix}'
+
+
+@contextmanager
+def profile(kind: str, path: str):
+    """Profile the body with `kind` (see `PROFILERS`) and write the result to `path`"""
+    if kind == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+    elif kind == 'sampling':
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            yield profiler
+        finally:
+            profiler.stop()
+            profiler.dump_stats(path)
+    else:
+        raise ValueError(f'unknown profiler {kind!r}')
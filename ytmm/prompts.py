@@ -0,0 +1,22 @@
+from rich.console import Console
+from rich.prompt import Confirm, Prompt
+
+# Answers when nobody can be asked
+DEFAULTS = {'ask': True, 'ask_all': 'a', 'confirm': False}
+
+
+def ask(kind: str, question: str, console: Console) -> bool | str:
+    """Ask `question` on `console`, `kind` is one of `DEFAULTS`"""
+    if kind == 'ask':
+        return Confirm.ask(f'[cyan]::[/] {question}', default=True, console=console)
+    if kind == 'ask_all':
+        return Prompt.ask (
+            fr'[cyan]::[/] {question} [prompt.choices]\[y/n/A]',
+            choices=['y','n','a','Y','N','A'],
+            default='A',
+            show_choices=False,
+            console=console
+        ).lower()
+    if kind == 'confirm':
+        return Confirm.ask(question, console=console)
+    raise ValueError(f'unknown prompt {kind!r}')
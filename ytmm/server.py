@@ -0,0 +1,218 @@
+import json, os, socket, socketserver, threading
+import concurrent.futures
+from contextlib import contextmanager
+from rich.console import Console
+from rich.markup import escape
+from .ytmm import YoutubeMM, Inventory, output, use_console
+from .pacing import Pacer
+from .client import socket_path
+from . import cli
+
+
+class SharedLock:
+    """Held by many in shared mode or by one in exclusive mode"""
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+
+    @contextmanager
+    def shared(self):
+        with self._cond:
+            while self._exclusive:
+                self._cond.wait()
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._shared -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._cond:
+            while self._exclusive or self._shared:
+                self._cond.wait()
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+
+class _StreamWriter:
+    # File object for a rich Console, forwards output to the client
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text: str) -> int:
+        if text:
+            self.wfile.write(json.dumps({'out': text}).encode() + b'\n')
+            self.wfile.flush()
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def send(self, **message):
+        self.wfile.write(json.dumps(message).encode() + b'\n')
+        self.wfile.flush()
+
+    def prompt(self, kind: str, question: str):
+        # Questions are answered by the user of the client, like they are locally
+        self.send(ask=kind, question=question)
+        line = self.rfile.readline()
+        if not line:
+            raise ConnectionError('client went away')
+        return json.loads(line)['answer']
+
+    def handle(self):
+        # Peers that connect and close (e.g. `_in_use`) send nothing
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        if not isinstance(request, dict) or not {'argv', 'cwd', 'database'} <= request.keys():
+            return
+        server: Server = self.server
+
+        try:
+            args = cli.create_parser().parse_args(request['argv'])
+        except SystemExit:
+            args = None
+        if args is None or args.command not in cli.SERVED_COMMANDS or request['database'] != server.database:
+            self.send(status=None)
+            return
+
+        console = Console (
+            file=_StreamWriter(self.wfile),
+            width=request.get('width') or 80,
+            force_terminal=request.get('terminal', False),
+            highlight=False,
+        )
+        with use_console(console, prompt=self.prompt, cwd=request['cwd']):
+            try:
+                server.run(args, request['cwd'])
+                status = 0
+            except Exception as e:
+                output.error(escape(str(e)))
+                status = 1
+        self.send(status=status)
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Keeps a loaded `YoutubeMM`, an inventory of the root directory and one
+    download pool resident, and runs CLI commands sent by `ytmm.client`.
+    """
+    daemon_threads = True
+
+    def __init__(self, mm: YoutubeMM, path: str):
+        self.mm = mm
+        self.path = path
+        self.database = os.path.abspath(mm.file)
+        self.lock = SharedLock()
+        self.save_lock = threading.Lock()
+        self._loaded()
+        super().__init__(path, _Handler)
+
+    def _loaded(self):
+        # Resolve paths once, clients can run from any directory
+        self.mm.base = os.path.abspath(self.mm.base or os.curdir)
+        self.mm.root = os.path.abspath(self.mm.root)
+        self.mm.inventory = Inventory(self.mm.root)
+        self.mtime = self._database_mtime()
+
+    def _database_mtime(self):
+        try:
+            return os.stat(self.database).st_mtime_ns
+        except OSError:
+            return None
+
+    def _changed(self) -> bool:
+        # Written by somebody else (e.g. `ytmm rm`), not by us (e.g. checkpoints of `add`)
+        return self._database_mtime() not in (self.mtime, self.mm.saved_mtime)
+
+    def reload_if_changed(self):
+        if not self._changed():
+            return
+        with self.lock.exclusive():
+            if self._changed() and not self.mm.modified:
+                self.mm.load()
+                self._loaded()
+
+    def save_if_modified(self):
+        with self.save_lock:
+            if self.mm.modified:
+                self.mm.modified = False
+                self.mm.save_to(self.mm.file)
+
+    def run(self, args, cwd: str):
+        self.reload_if_changed()
+        # `sync -o` temporarily changes root, nothing else may run meanwhile
+        lock = self.lock.exclusive if args.command == 'sync' else self.lock.shared
+        with lock():
+            root = self.mm.root
+            if args.command == 'sync' and args.output:
+                args.output = os.path.join(cwd, args.output)
+            try:
+                self.mm.inventory.refresh()
+                cli.run(self.mm, args)
+            finally:
+                self.mm.root = root
+        self.save_if_modified()
+
+    def rescan(self, interval: float):
+        # Directory mtimes can be coarse, so also rescan now and then
+        while not self._stop.wait(interval):
+            self.mm.inventory.refresh(force=True)
+
+    def serve(self, rescan: float):
+        self._stop = threading.Event()
+        threading.Thread(target=self.rescan, args=(rescan,), daemon=True).start()
+        try:
+            self.serve_forever()
+        finally:
+            self._stop.set()
+
+
+def _in_use(path: str) -> bool:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def serve(database: str | None = None, rescan: float = 60.0, pacer: Pacer | None = None):
+    with YoutubeMM(database, pacer=pacer) as mm:
+        try:
+            path = socket_path(mm.file)
+        except PermissionError as e:
+            output.error(escape(str(e)))
+            return
+        if os.path.exists(path):
+            if _in_use(path):
+                output.error('already serving', output.path(mm.file), 'on', output.path(path))
+                return
+            os.remove(path) # left behind by a server that crashed
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as mm.executor:
+            server = Server(mm, path)
+            output.section('Serving', output.path(mm.file), 'on', output.path(path))
+            try:
+                server.serve(rescan)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+                os.remove(path)
+                mm.executor = None
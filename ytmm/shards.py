@@ -0,0 +1,180 @@
+import json, os, threading
+from .utils import file_name_from_title, write_json_atomic
+
+"""
+Sharded database layout:
+
+music.json (manifest, always loaded):
+    'root':     str,
+    'shard_by': 'id' | 'artist',
+    'index':    {id: shard_key}  (in database order)
+    ...         other small database wide data (e.g. 'failed')
+
+music.d/<shard_key>.json (loaded on demand):
+    list[Entry]
+
+music.d/<sidecar>.json (loaded on demand):
+    database wide data too big for the manifest (e.g. 'fingerprints')
+"""
+
+SHARD_BY = ('id', 'artist')
+SIDECARS = ('fingerprints',) # never a shard key, those are at most 2 characters long
+
+
+def shard_key(entry: dict, shard_by: str) -> str:
+    if shard_by == 'artist':
+        artists = entry.get('artists') or ['']
+        name = file_name_from_title(artists[0])
+        return name[:2] or '_'
+    # YouTube IDs are case sensitive, but file systems might not be
+    c = entry['id'][0]
+    return c.lower() + ('_' if c.isupper() else '')
+
+
+def shard_dir(manifest_file: str) -> str:
+    return os.path.splitext(manifest_file)[0] + '.d'
+
+
+def is_sharded(db: dict) -> bool:
+    return 'index' in db and 'shard_by' in db
+
+
+class ShardedStore:
+    def __init__(self, manifest_file: str, shard_by: str, index: dict | None = None):
+        self.file     = manifest_file
+        self.dir      = shard_dir(manifest_file)
+        self.shard_by = shard_by
+        self.index    = dict(index or {})
+        self.shards   = {} # shard_key -> list[Entry]
+        self.dirty    = set()
+        self.manifest_dirty = False
+        self.lock = threading.RLock()
+
+    def __contains__(self, id: str) -> bool:
+        return id in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.dir, f'{key}.json')
+
+    def _shard(self, key: str) -> list:
+        with self.lock:
+            if key not in self.shards:
+                path = self._path(key)
+                # Files of keys not in the index are left over from another layout
+                if key in self.index.values() and os.path.exists(path):
+                    with open(path) as f:
+                        self.shards[key] = json.load(f)
+                else:
+                    self.shards[key] = []
+            return self.shards[key]
+
+    def get(self, id: str) -> dict | None:
+        key = self.index.get(id)
+        if key is None:
+            return None
+        for entry in self._shard(key):
+            if entry['id'] == id:
+                return entry
+        return None
+
+    def put(self, entry: dict):
+        with self.lock:
+            key = shard_key(entry, self.shard_by)
+            old = self.index.get(entry['id'])
+            if old is not None and old != key:
+                self.remove(entry['id'])
+            shard = self._shard(key)
+            for i, e in enumerate(shard):
+                if e['id'] == entry['id']:
+                    shard[i] = entry
+                    break
+            else:
+                shard.append(entry)
+            if self.index.get(entry['id']) != key:
+                self.index[entry['id']] = key
+                self.manifest_dirty = True
+            self.dirty.add(key)
+
+    def remove(self, id: str):
+        with self.lock:
+            key = self.index.pop(id, None)
+            if key is None:
+                return
+            shard = self._shard(key)
+            shard[:] = [e for e in shard if e['id'] != id]
+            self.dirty.add(key)
+            self.manifest_dirty = True
+
+    def all(self) -> list:
+        with self.lock:
+            by_id = {}
+            for key in set(self.index.values()):
+                for entry in self._shard(key):
+                    by_id[entry['id']] = entry
+            return [by_id[id] for id in self.index if id in by_id]
+
+    def replace_all(self, entries: list):
+        """Replace contents of the store, only shards that actually changed are marked dirty"""
+        with self.lock:
+            grouped = {}
+            for entry in entries:
+                grouped.setdefault(shard_key(entry, self.shard_by), []).append(entry)
+
+            for key in set(self.index.values()) | set(grouped):
+                new = grouped.get(key, [])
+                if self._shard(key) != new:
+                    self.shards[key] = new
+                    self.dirty.add(key)
+
+            index = {entry['id']: shard_key(entry, self.shard_by) for entry in entries}
+            if list(index.items()) != list(self.index.items()):
+                self.index = index
+                self.manifest_dirty = True
+
+    def modified(self) -> bool:
+        return self.manifest_dirty or bool(self.dirty)
+
+    def load_sidecar(self, name: str):
+        path = self._path(name)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def save(self, root: str, sidecars: dict | None = None, **extra) -> list:
+        """Write manifest, dirty shards and `sidecars` (by name), returns the shard files written"""
+        with self.lock:
+            os.makedirs(self.dir, exist_ok=True)
+            for name, data in (sidecars or {}).items():
+                if data:
+                    write_json_atomic(self._path(name), data)
+                elif os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+            written = []
+            for key in sorted(self.dirty):
+                path = self._path(key)
+                if self.shards[key]:
+                    write_json_atomic(path, self.shards[key], indent=4)
+                    written.append(path)
+                elif os.path.exists(path):
+                    os.remove(path)
+            self.dirty.clear()
+            write_json_atomic(self.file, self.manifest(root, **extra), indent=4)
+            if self.manifest_dirty:
+                self._prune()
+            self.manifest_dirty = False
+            return written
+
+    def _prune(self):
+        # Remove shard files that are no longer in the index (e.g. after changing `shard_by`)
+        keys = set(self.index.values())
+        for name in os.listdir(self.dir):
+            key, ext = os.path.splitext(name)
+            if ext == '.json' and key not in keys and key not in SIDECARS:
+                os.remove(os.path.join(self.dir, name))
+
+    def manifest(self, root: str, **extra) -> dict:
+        return {'root': root, 'shard_by': self.shard_by, 'index': self.index, **extra}
@@ -0,0 +1,135 @@
+import os, shutil, subprocess
+from dataclasses import dataclass, asdict
+
+DEFAULT_PROFILE   = 'default'
+SOURCE_CACHE_SIZE = 4 * 1024**3 # bytes
+
+# ffmpeg encoders for profile codecs
+ENCODERS = {
+    'mp3':    'libmp3lame',
+    'opus':   'libopus',
+    'aac':    'aac',
+    'vorbis': 'libvorbis',
+    'flac':   'flac',
+    'copy':   'copy',
+}
+
+# Files yt-dlp leaves behind while downloading
+PARTIAL_SUFFIXES = ('.part', '.ytdl', '.temp')
+
+
+@dataclass(frozen=True)
+class OutputProfile:
+    name:    str
+    codec:   str               # key of ENCODERS
+    ext:     str               # container, from the file extension
+    bitrate: str | None = None # e.g. '64k'
+    quality: str | None = None # VBR quality, used when there is no bitrate
+    root:    str | None = None # output directory (default: root for 'default', otherwise "<root>-<name>")
+
+    def __post_init__(self):
+        if self.codec not in ENCODERS:
+            raise ValueError(f'profile {self.name!r}: unknown codec {self.codec!r}')
+
+    def codec_args(self) -> list:
+        args = ['-c:a', ENCODERS[self.codec]]
+        if self.codec == 'copy':
+            return args
+        if self.bitrate:
+            args += ['-b:a', self.bitrate]
+        elif self.quality:
+            args += ['-q:a', self.quality]
+        return args
+
+    def to_dict(self) -> dict:
+        return {k: v for k, v in asdict(self).items() if v is not None and k != 'name'}
+
+
+BUILTIN_PROFILES = {
+    # What ytmm always produced: mp3, VBR quality 5
+    'default': OutputProfile('default', 'mp3',  'mp3', quality='5'),
+    'phone':   OutputProfile('phone',   'opus', 'opus', bitrate='64k'),
+    # Original stream without re-encoding, Matroska can hold any audio codec
+    'archive': OutputProfile('archive', 'copy', 'mka'),
+}
+
+
+def load_profiles(custom: dict | None) -> dict:
+    """Built-in profiles updated with the 'profiles' of a database"""
+    profiles = dict(BUILTIN_PROFILES)
+    for name, options in (custom or {}).items():
+        profiles[name] = OutputProfile(name, **options)
+    return profiles
+
+
+class SourceCache:
+    """Original downloaded audio streams by video id, evicting the least recently used"""
+    def __init__(self, directory: str, max_bytes: int = SOURCE_CACHE_SIZE):
+        self.dir = directory
+        self.max_bytes = max_bytes
+        self.files = None # id -> path, see `scan`
+
+    def template(self) -> str:
+        # yt-dlp output template
+        return os.path.join(self.dir, '%(id)s.%(ext)s')
+
+    def scan(self):
+        """Index the cache, lookups use the index until the next scan"""
+        files = {}
+        if os.path.isdir(self.dir):
+            for entry in os.scandir(self.dir):
+                id, ext = os.path.splitext(entry.name)
+                if ext not in PARTIAL_SUFFIXES and entry.is_file():
+                    files[id] = entry.path
+        self.files = files
+
+    def find(self, id: str, rescan: bool = False) -> str | None:
+        if rescan or self.files is None:
+            self.scan()
+        return self.files.get(id)
+
+    def touch(self, path: str):
+        # Mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def evict(self) -> list:
+        """Remove least recently used sources until the cache fits, returns removed files"""
+        if not os.path.isdir(self.dir):
+            return []
+        files = [e for e in os.scandir(self.dir) if e.is_file() and not e.name.endswith(PARTIAL_SUFFIXES)]
+        files.sort(key=lambda e: e.stat().st_mtime)
+        total = sum(e.stat().st_size for e in files)
+        removed = []
+        for e in files:
+            if total <= self.max_bytes:
+                break
+            total -= e.stat().st_size
+            os.remove(e.path)
+            removed.append(e.path)
+        if removed:
+            self.files = None
+        return removed
+
+
+def transcode(source: str, path: str, profile: OutputProfile, metadata: dict):
+    """Write `source` as `path` using `profile`, runs ffmpeg only (no network)"""
+    if not shutil.which('ffmpeg'):
+        raise RuntimeError('ffmpeg not found')
+    directory, name = os.path.split(path)
+    tmp = os.path.join(directory, f'.{name}.tmp.{profile.ext}')
+    command = ['ffmpeg', '-nostdin', '-y', '-v', 'error', '-i', source, '-vn', '-map', '0:a:0', '-map_metadata', '-1']
+    for key, value in metadata.items():
+        if value is not None:
+            command += ['-metadata', f'{key}={value}']
+    command += profile.codec_args() + [tmp]
+    try:
+        subprocess.run(command, capture_output=True, text=True, check=True)
+        os.replace(tmp, path)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f'ffmpeg failed for {name}: {e.stderr.strip()}') from e
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
@@ -1,12 +1,16 @@
-import re
+import json, os, re, stat, tempfile
+from functools import lru_cache
 
 re_feat    = re.compile(r'\(feat\. .*\)')
 re_invalid = re.compile(r'[^ 0-9A-Za-z_]')
 re_space   = re.compile(r'\s+')
 re_bracket = re.compile(r'\[.*\]')
 re_garbage = re.compile(r'\(Official .*\)|\(From .*\)|\(feat\. .*\)')
+re_video_id = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([0-9A-Za-z_-]{11})(?![0-9A-Za-z_-])')
+re_bare_id  = re.compile(r'[0-9A-Za-z_-]{11}')
 
 
+@lru_cache(maxsize=1<<16)
 def file_name_from_title(title: str):
     # Remove (feat. {})
     title = re_garbage.sub('', title).strip()
@@ -21,6 +25,23 @@ def file_name_from_title(title: str):
     return title.lower().replace(' ', '_')
 
 
+def write_json_atomic(path: str, data, **kwargs):
+    # Write to a temporary file next to `path`, a crash never leaves a partial file behind
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, **kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        mode = stat.S_IMODE(os.stat(path).st_mode) if os.path.exists(path) else 0o644
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
 def parse_title(old: str):
     # Remove garbage from title
     old = re_garbage.sub('', old).strip()
@@ -37,6 +58,15 @@ def parse_title(old: str):
     return artists, title
 
 
+def video_id_from_url(url: str) -> str | None:
+    if re_bare_id.fullmatch(url):
+        return url
+    match = re_video_id.search(url)
+    if match:
+        return match.group(1)
+    return None
+
+
 def filter_entries(entries, title_pattern: str | None, artist_pattern: str | None):
     # No patterns given
     if not (title_pattern or artist_pattern):
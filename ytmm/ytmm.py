@@ -1,14 +1,30 @@
-import logging, json, os, shutil, re
-import concurrent.futures
+import logging, json, os, shutil, re, threading, time
+import concurrent.futures, functools
+from contextlib import contextmanager
 import yt_dlp
 from .utils import (
     file_name_from_title,
     parse_title,
     filter_entries,
+    video_id_from_url,
+    write_json_atomic,
+)
+from .shards import ShardedStore, is_sharded, shard_dir, SHARD_BY
+from .locate import DEFAULT_DATABASE, DEFAULT_ROOT, find_database, cache_dir
+from .pacing import Pacer, METADATA, MEDIA
+from .fingerprint import FingerprintIndex, fingerprint, has_chromaprint, title_key
+from .profiling import Spans
+from . import prompts
+from .transcode import (
+    DEFAULT_PROFILE,
+    OutputProfile,
+    SourceCache,
+    load_profiles,
+    transcode,
 )
 from rich.markup import escape
+from rich.filesize import decimal
 from rich.console import Console
-from rich.prompt import Confirm, Prompt
 from rich.progress import (
     Progress,
     SpinnerColumn,
@@ -19,10 +35,43 @@ from rich.progress import (
 )
 from collections.abc import Callable
 
-DEFAULT_DATABASE = 'music.json'
-DEFAULT_ROOT     = 'music'
+CHECKPOINT_EVERY    = 10   # successful downloads between database writes
+CHECKPOINT_INTERVAL = 30.0 # seconds between database writes
+
+class _ThreadOutput(threading.local):
+    console = Console(highlight=False)
+    interactive = True
+    prompt = None # (kind, question) -> answer, see `prompts.ask`
+    cwd = None    # directory printed paths are relative to
+
+_local = _ThreadOutput()
 
-console = Console(highlight=False)
+class _ConsoleProxy:
+    # Forwards to the console of the current thread (see `use_console`)
+    def __getattr__(self, name):
+        return getattr(_local.console, name)
+
+console = _ConsoleProxy()
+
+@contextmanager
+def use_console(c: Console, interactive: bool = True, prompt=None, cwd: str | None = None):
+    """
+    Send output of the current thread to `c`, questions go to `prompt` if given.
+    Prompts take their default when not `interactive`.
+    """
+    old = _local.console, _local.interactive, _local.prompt, _local.cwd
+    _local.console, _local.interactive, _local.prompt, _local.cwd = c, interactive, prompt, cwd
+    try:
+        yield c
+    finally:
+        _local.console, _local.interactive, _local.prompt, _local.cwd = old
+
+def _prompt(kind: str, question: str):
+    if _local.prompt is not None:
+        return _local.prompt(kind, question)
+    if not _local.interactive:
+        return prompts.DEFAULTS[kind]
+    return prompts.ask(kind, question, _local.console)
 
 def line_text(text: str, width: int) -> str:
     k = max(width,0) - len(text) - 2
@@ -38,6 +87,8 @@ Entry:
     'album':   str,       [optional]
     'year':    int,       [optional]
     'path':    str        [optional] (defaults to root)
+    'link':    str        [optional] id of the entry whose file has the same audio
+    'variants': list[str] [optional] output profiles that were transcoded
 """
 
 
@@ -50,37 +101,49 @@ class output:
         console.print('[red]error[/]:', *values, **kwargs)
     def path(p):
         return f'[green1]"{escape(p)}"[/green1]'
+    def file(p):
+        # Relative to the directory of the user (differs from ours when served)
+        return os.path.relpath(p, _local.cwd) if _local.cwd else p
     def ask(q):
-        return Confirm.ask(f'[cyan]::[/] {q}', default=True)
+        return _prompt('ask', q)
     def ask_all(q):
-        return Prompt.ask (
-            fr'[cyan]::[/] {q} [prompt.choices]\[y/n/A]',
-            choices=['y','n','a','Y','N','A'],
-            default='A',
-            show_choices=False
-        ).lower()
+        return _prompt('ask_all', q)
+    def confirm(q):
+        return _prompt('confirm', q)
 
 
 
 
-def find_database(database):
-    dirs = []
-    for file in os.listdir('.'):
-        if os.path.isdir(file):
-            if file != DEFAULT_ROOT:
-                dirs.append(file)
-        else:
-            if file == DEFAULT_DATABASE:
-                return file
+def _phased(method):
+    # Method records its phases (see `Spans.phase`)
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.spans.phases():
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
-    for root in dirs:
-        for file in os.listdir(root):
-            path = os.path.join(root, file)
-            if os.path.isdir(path): continue
-            if file == DEFAULT_DATABASE:
-                return path
 
-    return None
+
+class Inventory:
+    """File names in the root directory, rescanned only when the directory changes"""
+    def __init__(self, root: str):
+        self.root  = root
+        self.files = set()
+        self.mtime = None
+
+    def refresh(self, force=False):
+        try:
+            mtime = os.stat(self.root).st_mtime_ns
+        except OSError:
+            self.files, self.mtime = set(), None
+            return
+        if force or mtime != self.mtime:
+            self.files = {e.name for e in os.scandir(self.root) if e.is_file()}
+            self.mtime = mtime
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.files
 
 
 
@@ -90,19 +153,39 @@ class ProgressTracker:
         self.progress = progress
         self.n = n
         self.errors = []
+        self.linked = [] # (entry, original, reason)
+        self.totalid = None
+        self.current = threading.local() # `url` and last `error` of a download thread
+        self.pacingid = progress.add_task('', total=None, visible=False)
     
     def save_error(self, error):
         self.errors.append(error)
+        self.current.error = error
+
+    def set_pacing(self, status: str):
+        self.progress.update(self.pacingid, description=f'[yellow]{escape(status)}', visible=bool(status))
+
+    def download_tasks(self):
+        return [t for t in self.progress.tasks if t.id not in (self.totalid, self.pacingid)]
 
 
 
 
 class YoutubeMM:
-    def __init__(self, database=DEFAULT_DATABASE):
+    def __init__(self, database: str | None = None, pacer: Pacer | None = None, spans: Spans | None = None):
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
-        self.file = find_database(database)
+        self.file, self.base = find_database(database)
+        self.pacer = pacer or Pacer()
+        self.spans = spans or Spans()
         self.modified = False
+        self.executor  = None # shared download pool (see `serve`), otherwise one per command
+        self.inventory = None # file names in root, otherwise checked with the file system
+        self.sources   = SourceCache(os.path.join(cache_dir(), 'sources'))
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self.checkpoint_every    = CHECKPOINT_EVERY
+        self.checkpoint_interval = CHECKPOINT_INTERVAL
         #self.logger.info("database file: %s", database_file)
 
     def __enter__(self):
@@ -116,13 +199,21 @@ class YoutubeMM:
 
 
 
+    @_phased
     def sync (
         self,
         output_dir: str | None,
         title_pattern: str | None,
-        artist_pattern: str | None
+        artist_pattern: str | None,
+        profiles: list[str] | None = None
     ) -> None:
         # TODO: audit code
+        self.spans.phase('plan')
+        try:
+            profiles = [self.profile(name) for name in profiles or [DEFAULT_PROFILE]]
+        except ValueError as e:
+            output.error(escape(str(e)))
+            return
 
         if output_dir:
             self.root = output_dir
@@ -162,113 +253,146 @@ class YoutubeMM:
                         output.status('[cyan]repaired', escape(stem), '=>', escape(entry['title']))
                         continue
                     
-                    if Confirm.ask(f'remove [red]"{escape(f)}"[/]?'):
+                    if output.confirm(f'remove [red]"{escape(f)}"[/]?'):
                         os.remove(os.path.join(root, f))
 
         # Filter by given patterns 
         filtered = filter_entries(self.entries, title_pattern, artist_pattern)
+        self.sources.scan()
 
         entries = []
+        needed  = []
+        ids = set()
         # Only download what does not exist
         for entry in filtered:
-            file_name = f"{file_name_from_title(entry['title'])}.mp3"
-            path = os.path.join(self.root, file_name)
-
-            if not os.path.exists(path):
-                output.status('[red]missing', f'[i]{escape(entry['title'])}')
-                entries.append(entry)
+            # Duplicates are restored by downloading the entry they link to
+            entry = self._link_target(entry) or entry
+            missing = [p for p in profiles if not self.is_downloaded(entry, p)]
+            if not missing or entry['id'] in ids: continue
+            # Cached sources only need to be transcoded
+            source = '[cyan](cached)' if self.sources.find(entry['id']) else ''
+            variants = f'[grey39]({', '.join(p.name for p in missing)})' if missing != [self.profiles[DEFAULT_PROFILE]] else ''
+            output.status('[red]missing', f'[i]{escape(entry['title'])}[/]', variants, source)
+            entries.append(entry)
+            needed.append(missing)
+            ids.add(entry['id'])
 
         if not entries:
             output.status("nothing to do")
             return
 
-        print()
+        console.print()
         output.section("Music to download:")
         for entry in entries:
             output.status(escape(file_name_from_title(entry['title'])), end=' ')
-        print('\n')
+        console.print('\n')
 
         if not output.ask("Proceed to download?"): return
 
-        self.download(entries)
+        self.spans.phase('execute')
+        self.download(entries, needed)
+        self.sources.evict()
+
+
 
 
+    @_phased
+    def add(self, urls: list, retry_failed: bool = False):
+        self.spans.phase('plan')
+        if retry_failed:
+            urls = [url for url in self.failed if url not in urls] + list(urls)
+            output.status(f'retrying {len(self.failed)} failed URL(s)...')
 
+        ids = self.ids()
 
-    def add(self, urls: list):
-        def find(s: str):
-            for u, url in enumerate(urls):
-                if s in url:
-                    return u, url
-            return None, None
+        def find(url: str):
+            id = video_id_from_url(url)
+            if id is not None:
+                return id if id in ids else None
+            # Not a URL we know how to parse, fall back to searching
+            for id in ids:
+                if id in url:
+                    return id
+            return None
 
         output.status("looking for duplicates...")
 
         yes_to_all = False
-        replace = [-1 for _ in urls]
-        for i, entry in enumerate(self.entries):
-            j, url = find(entry['id'])
-            if j != None:
+        download_list = []
+        for url in urls:
+            id = find(url)
+            if id is not None:
+                entry = self.get_entry(id)
                 output.status(f'found [u orange1]{escape(url)}[/] as [green1]"{escape(entry['title'])}"')
 
-                if yes_to_all:
-                    replace[j] = i
-                    continue
-
-                match output.ask_all("Replace existing?"):
-                    case 'y': replace[j] = i
-                    case 'n': replace[j] = None
-                    case 'a': replace[j] = i; yes_to_all = True
-
-        download_list = []
-        # None -> remove
-        for i,r in enumerate(replace):
-            if r != None:
-                download_list.append((urls[i], r))
+                if not yes_to_all:
+                    match output.ask_all("Replace existing?"):
+                        case 'n': continue
+                        case 'a': yes_to_all = True
+            download_list.append(url)
 
         if not download_list: return
 
+        self.spans.phase('execute')
         output.section("Downloading music...")
 
-        def download(url: str, task_id, index: int):
-            progress.update(task_id, visible=True)
-            info = d.extract_info(url, download=True, extra_info={'ytmm_task_id': task_id})
-            new_entry = _info_to_entry(info)
-            self._rename_entry(new_entry)
-        
-            if index >= 0:
-                self.entries[index] = new_entry
-            else:
-                self.entries.append(new_entry)
+        checkpoint = self._checkpointer()
 
-            self.modified = True
+        def download(url: str, task_id):
+            tracker.current.url, tracker.current.error = url, None
+            try:
+                progress.update(task_id, visible=True)
+                info = self._fetch(d, url, {'ytmm_task_id': task_id})
+                new_entry = _info_to_entry(info)
+                self._produce(new_entry, self._source(info), [self.profiles[DEFAULT_PROFILE]])
+                self._link_duplicate(new_entry, tracker, info.get('duration'))
+            except Exception as e:
+                self._failed(url, tracker.current.error or str(e))
+                return
+            with self._lock:
+                self._put_entry(new_entry)
+                self.failed.pop(url, None)
+                self.modified = True
             progress.update(task_id, advance=1)
-            
+            checkpoint()
+
         with Progress (
             SpinnerColumn(),
             TextColumn("[progress.description]{task.description}"),
             BarColumn(None),
             TaskProgressColumn(),
             TimeElapsedColumn(),
+            console=_local.console,
             expand=True
         ) as progress:
             tracker = ProgressTracker(len(download_list), progress)
-            with self.downloader(tracker) as d:
-                with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
-                    for url, index in download_list:
+            with self.pacer.listen(tracker.set_pacing), self.downloader(tracker) as d:
+                with self._executor() as executor:
+                    futures = []
+                    for url in download_list:
                         task_id = progress.add_task(url, start=False, total=None, visible=False)
-                        executor.submit(download, url, task_id, index)
+                        futures.append(executor.submit(download, url, task_id))
                     total_taskid = progress.add_task('-- Total --', total=None)
                     tracker.totalid = total_taskid
-                    executor.shutdown()
+                    try:
+                        concurrent.futures.wait(futures)
+                    except KeyboardInterrupt:
+                        # Finished items are kept, the rest can be added again with --retry-failed
+                        for url, future in zip(download_list, futures):
+                            if future.cancel():
+                                self._failed(url, 'interrupted')
+                        raise
                 tracker.progress.update(tracker.totalid, completed=100)
         
-        for error in tracker.errors:
-            output.error(escape(error.replace('ERROR: ','')))
+        self._report(tracker)
+        self.sources.evict()
+        if self.failed:
+            output.status(f'{len(self.failed)} URL(s) failed, run [b]ytmm add --retry-failed[/] to try again')
 
 
 
 
+    @_phased
     def query (
         self,
         title_pattern:  str  | None = None,
@@ -278,6 +402,7 @@ class YoutubeMM:
         custom_filter:  Callable[[dict], dict] | None = None
     ) -> None:
         # TODO: Print less info if terminal width is small (Title > Artists > Year > ID)
+        self.spans.phase('plan')
 
         import time
 
@@ -298,7 +423,7 @@ class YoutubeMM:
                 return '[rgb(0,255,255)]'
 
         def downloaded_eq(entry):
-            return os.path.isfile(self.entry_path(entry)) == downloaded
+            return self.is_downloaded(entry) == downloaded
 
         if downloaded is not None:
             filtered = list(filter(downloaded_eq, self.entries))
@@ -309,9 +434,10 @@ class YoutubeMM:
         if custom_filter:
             filtered = custom_filter(filtered)
 
+        self.spans.phase('execute')
         if files:
             for entry in filtered:
-                print(self.entry_path(entry))
+                console.print(output.file(self.entry_path(entry)), markup=False, soft_wrap=True)
             return
         
         from rich.table import Column, Table
@@ -336,7 +462,9 @@ class YoutubeMM:
 
 
 
+    @_phased
     def count(self) -> None:
+        self.spans.phase('plan')
         from rich.table import Column, Table
         from rich import box
 
@@ -351,19 +479,23 @@ class YoutubeMM:
         total = len(self.entries)
 
         def download_mask(entry):
-            if os.path.isfile(self.entry_path(entry)):
+            if self.is_downloaded(entry):
                 return 1
             return 0
         
         downloaded = sum(download_mask(entry) for entry in self.entries)
         table.add_row(str(total), str(downloaded), str(total-downloaded))
 
+        self.spans.phase('execute')
+
         console.print(table)
 
 
 
 
+    @_phased
     def remove(self, title_pattern: str, artist_pattern: str | None):
+        self.spans.phase('plan')
         output.status("looking for music...")
 
         filtered = filter_entries(self.entries, title_pattern, artist_pattern)
@@ -372,38 +504,166 @@ class YoutubeMM:
         output.section("Music to remove:")
         for entry in filtered:
             output.status(file_name_from_title(entry['title']), end=' ')
-        print('\n')
+        console.print('\n')
         
         if not output.ask("Proceed?"): return
 
-        # TODO: This is very dumb! FIX
-        def keep(entry):
-            for f in filtered:
-                if entry['id'] == f['id']:
-                    file_name = file_name_from_title(entry['title']) + '.mp3'
-                    path = os.path.join(self.root, file_name)
-                    if os.path.exists(path):
-                        os.remove(path)
-                        output.status(f"removed {file_name}...")
-                    return False
-            return True
-
-        self.entries = list(filter(keep, self.entries))
+        self.spans.phase('execute')
+        removed = {entry['id'] for entry in filtered}
+        for entry in filtered:
+            if 'link' in entry: # file belongs to the linked entry
+                continue
+            dependents = [e for e in self.entries if e.get('link') == entry['id'] and e['id'] not in removed]
+            if dependents:
+                self._hand_over(entry, dependents)
+                continue
+            for path in self._own_files(entry):
+                os.remove(path)
+                output.status(f"removed {os.path.basename(path)}...")
+
+        self.entries = [entry for entry in self.entries if entry['id'] not in removed]
+        for id in removed:
+            self.fingerprints.remove(id)
         self.modified = True
 
+    def _hand_over(self, entry, dependents: list):
+        # Files of a removed entry go to the first entry linked to it, the others link to that one
+        owner = dependents[0]
+        del owner['link']
+        for profile in self.profiles.values():
+            path = self.entry_path(entry, profile)
+            if os.path.exists(path):
+                shutil.move(path, self.entry_path(owner, profile))
+                output.status(f"moved {os.path.basename(path)} => {os.path.basename(self.entry_path(owner, profile))}")
+        if 'variants' in entry:
+            owner['variants'] = entry['variants']
+        for other in dependents[1:]:
+            other['link'] = owner['id']
+        fp = self.fingerprints.fingerprints.get(entry['id'])
+        if fp is not None:
+            self.fingerprints.remove(entry['id'])
+            self.fingerprints.add(owner['id'], {**fp, 'key': title_key(owner)})
+
+
+
+
+    @_phased
+    def dedupe(self):
+        self.spans.phase('plan')
+        output.section("Fingerprinting music...")
+        if not has_chromaprint():
+            output.status('[yellow]fpcalc (chromaprint) not found[/], only identical audio data or the same title and length is found')
+
+        missing = [e for e in self.entries if 'link' not in e and e['id'] not in self.fingerprints.fingerprints and self.is_downloaded(e)]
+        def compute(entry):
+            return entry['id'], fingerprint(self.entry_path(entry), entry)
+        with console.status(f'fingerprinting {len(missing)} file(s)...'), self._executor() as executor:
+            for id, fp in executor.map(compute, missing):
+                self.fingerprints.add(id, fp)
+                self.modified = True
+
+        # First entry with some audio is the original, later ones are duplicates
+        index = FingerprintIndex()
+        duplicates = []
+        for entry in self.entries:
+            fp = self.fingerprints.fingerprints.get(entry['id'])
+            if fp is None or 'link' in entry: continue
+            match = index.match(entry['id'], fp)
+            if match is None:
+                index.add(entry['id'], fp)
+                continue
+            original = self.get_entry(match[0])
+            size = sum(os.path.getsize(path) for path in self._own_files(entry, original))
+            duplicates.append((entry, original, match[1], size))
+
+        if not duplicates:
+            output.status("no duplicates found")
+            return
+
+        from rich.table import Column, Table
+
+        table = Table(
+            Column(header="Duplicate", style="medium_spring_green", no_wrap=True, ratio=3),
+            Column(header="Original",  style="medium_spring_green", no_wrap=True, ratio=3),
+            Column(header="Match",     style="italic orchid1",      no_wrap=True),
+            Column(header="Size",      style="dodger_blue1",        no_wrap=True, justify='right'),
+            box=None,
+            expand=True
+        )
+        for entry, original, reason, size in duplicates:
+            table.add_row(entry['title'], original['title'], reason, decimal(size))
+        console.print(table)
+
+        reclaimed = sum(d[3] for d in duplicates)
+        output.section(f'{len(duplicates)} duplicate(s), reclaims [b]{decimal(reclaimed)}')
+        if not output.ask("Link duplicates and remove their files?"): return
+
+        self.spans.phase('execute')
+        linked = {}
+        for entry, original, reason, size in duplicates:
+            for path in self._own_files(entry, original):
+                os.remove(path)
+            self.fingerprints.remove(entry['id'])
+            linked[entry['id']] = original['id']
+
+        def link(entry):
+            target = linked.get(entry['id']) or linked.get(entry.get('link'))
+            if target is None:
+                return entry
+            return {**{k: v for k, v in entry.items() if k != 'variants'}, 'link': target}
+
+        self.entries = [link(entry) for entry in self.entries]
+        self.modified = True
+        output.status(f'linked {len(linked)} duplicate(s)')
+
 
 
 
-    def download(self, entries):
+    def download(self, entries, profiles: list[list[OutputProfile]] | None = None):
+        """Make `profiles[i]` (default profile if not given) of `entries[i]`, the network is only used for sources not in the cache"""
         output.section("Retrieving music...")
 
+        profiles = profiles or [[self.profiles[DEFAULT_PROFILE]] for _ in entries]
+        checkpoint = self._checkpointer()
+        transcodes = []
+
         def download(i, task_id):
             entry = entries[i]
             extra = {'ytmm_task_id': task_id, 'index': i}
-            progress.update(task_id, visible=True)
-            d.extract_info(entry['id'], download=True, extra_info=extra)
-            self._rename_entry(entry)
-            progress.update(task_id, advance=1)
+            tracker.current.url, tracker.current.error = entry['id'], None
+            try:
+                progress.update(task_id, visible=True)
+                info = {}
+                source = self.sources.find(entry['id'])
+                if source is None:
+                    info = self._fetch(d, entry['id'], extra)
+                    source = self._source(info)
+            except Exception as e:
+                if tracker.current.error is None:
+                    tracker.save_error(f'{entry['title']}: {e}')
+                return
+            # One job per profile, the last one to finish completes the entry
+            state = {'left': len(profiles[i]), 'duration': info.get('duration')}
+            for profile in profiles[i]:
+                transcodes.append(executor.submit(transcode, i, task_id, source, profile, state))
+
+        def transcode(i, task_id, source, profile, state):
+            entry = entries[i]
+            try:
+                self._produce(entry, source, [profile])
+            except Exception as e:
+                tracker.save_error(f'{entry['title']} ({profile.name}): {e}')
+            with self._lock:
+                state['left'] -= 1
+                if state['left']: return
+            if DEFAULT_PROFILE in entry.get('variants', []):
+                self._link_duplicate(entry, tracker, state['duration'])
+            with self._lock:
+                self._put_entry(entry)
+                self.modified = True
+            progress.start_task(task_id)
+            progress.update(task_id, total=1, completed=1)
+            checkpoint()
 
         with Progress (
             SpinnerColumn(),
@@ -411,63 +671,240 @@ class YoutubeMM:
             BarColumn(None),
             TaskProgressColumn(),
             TimeElapsedColumn(),
+            console=_local.console,
             expand=True
         ) as progress:
             tracker = ProgressTracker(len(entries), progress)
-            with self.downloader(tracker) as d:
-                with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            with self.pacer.listen(tracker.set_pacing), self.downloader(tracker) as d:
+                with self._executor() as executor:
+                    futures = []
                     for i in range(len(entries)):
                         task_id = progress.add_task(entries[i]['title'], start=False, total=None, visible=False)
-                        executor.submit(download, i, task_id)
+                        futures.append(executor.submit(download, i, task_id))
                     total_taskid = progress.add_task('Total', total=None)
                     tracker.totalid = total_taskid
-                    executor.shutdown()
-                tracker.progress.update(tracker.totalid, completed=100)
+                    concurrent.futures.wait(futures)
+                    # Every transcode was submitted by a finished download
+                    concurrent.futures.wait(transcodes)
+                tracker.progress.update(tracker.totalid, total=100, completed=100)
+
+        self._report(tracker)
+
+
+
+
+    @property
+    def fingerprints(self) -> FingerprintIndex:
+        # Sharded databases keep them in their own file, only finding duplicates needs them
+        if self._fingerprints is None:
+            self._fingerprints = FingerprintIndex(self.store.load_sidecar('fingerprints'))
+        return self._fingerprints
+
+    @property
+    def entries(self) -> list:
+        # Sharded databases only load every shard when all entries are needed
+        if self._entries is None:
+            self._entries = self.store.all()
+        return self._entries
+
+    @entries.setter
+    def entries(self, entries: list):
+        self._entries = entries
+
+    def ids(self):
+        if self._entries is None:
+            return self.store.index
+        return {entry['id'] for entry in self._entries}
+
+    def get_entry(self, id: str) -> dict | None:
+        if self._entries is None:
+            return self.store.get(id)
+        for entry in self._entries:
+            if entry['id'] == id:
+                return entry
+        return None
+
+    def _put_entry(self, entry: dict):
+        if self._entries is not None:
+            for i, e in enumerate(self._entries):
+                if e['id'] == entry['id']:
+                    self._entries[i] = entry
+                    break
+            else:
+                self._entries.append(entry)
+        if self.store is not None:
+            self.store.put(entry)
+
+
+
+
+    def show_profiles(self):
+        output.section("Output profiles")
+        for profile in self.profiles.values():
+            setting = profile.bitrate or (profile.quality and f'q{profile.quality}') or ''
+            output.status (
+                f'[b]{escape(profile.name)}[/]',
+                f'{profile.codec} {setting}'.strip(),
+                f'.{profile.ext}',
+                output.path(self.profile_root(profile))
+            )
 
 
 
 
+    @_phased
+    def shard(self, shard_by: str | None):
+        """Convert database to the sharded layout (or back to a single file when `shard_by` is None)"""
+        self.spans.phase('execute')
+        entries = self.entries
+        self.fingerprints # moves with the database
+        self._saved_fingerprints = None
+        if shard_by is None:
+            self.store = None
+        else:
+            if shard_by not in SHARD_BY:
+                raise ValueError(f'cannot shard by {shard_by!r}')
+            self.store = ShardedStore(self.file, shard_by)
+            self.store.replace_all(entries)
+        self.modified = True
+
+
+
+
+    @_phased
     def load(self):
+        self.spans.phase('load')
+        self.store = None
+        self._entries = None
+        self._fingerprints = FingerprintIndex()
+        self._saved_fingerprints = 0 # `FingerprintIndex.version` in the database file
+        self.saved_mtime = None # of the database file after our last write
+        self.failed = {} # url -> {'error': str, 'attempts': int}
+        self.custom_profiles = {}
+        self.profiles = load_profiles(None)
         if os.path.exists(self.file):
             try:
                 db = json.load(open(self.file))
-                if 'data' in db:
+                self._fingerprints = FingerprintIndex(db.get('fingerprints'))
+                self.failed = db.get('failed', {})
+                self.custom_profiles = db.get('profiles', {})
+                self.profiles = load_profiles(self.custom_profiles)
+                if is_sharded(db):
+                    self.store = ShardedStore(self.file, db['shard_by'], db['index'])
+                    if 'fingerprints' in db:
+                        # Written by an older version, move them out of the manifest
+                        self._saved_fingerprints = None
+                        self.modified = True
+                    else:
+                        self._fingerprints = None # loaded when needed
+                elif 'data' in db:
                     self.entries = db['data']
                 else:
                     output.status("'data' not found, creating empty database...")
                     self.entries = []
                     self.modified = True
                 if 'root' in db:
-                    self.root = db['root']
+                    self.root = os.path.join(self.base, db['root'])
                 else:
-                    output.status("'root' not found, using", output.file(DEFAULT_ROOT))
-                    self.root = DEFAULT_ROOT
+                    output.status("'root' not found, using", output.path(DEFAULT_ROOT))
+                    self.root = os.path.join(self.base, DEFAULT_ROOT)
                     self.modified = True
             except Exception as e:
                 output.error("Failed to load database")
                 output.error(e)
                 exit(1)
         else:
-            output.status(output.file(self.file), "not found, creating new database...")
+            output.status(output.path(self.file), "not found, creating new database...")
             self.entries  = []
-            self.root     = DEFAULT_ROOT
+            self.root     = os.path.join(self.base, DEFAULT_ROOT)
             self.modified = True
 
 
 
 
-    def save_to(self, file):
-        with open(file, "w") as f:
+    @_phased
+    def save_to(self, file, quiet: bool = False):
+        self.spans.phase('save')
+        if not quiet:
             output.section("Saving changes...")
+        with self._save_lock:
             try:
-                json.dump({'root': self.root, 'data': self.entries}, f, indent=4)
-                output.status('wrote to database', output.path(self.file))
+                # Snapshot under the lock, download threads keep modifying the database
+                with self._lock:
+                    extra = {}
+                    fingerprints = None
+                    if self._fingerprints is not None:
+                        fingerprints = dict(self._fingerprints.fingerprints)
+                        version = self._fingerprints.version
+                    if self.failed:
+                        extra['failed'] = dict(self.failed)
+                    if self.custom_profiles:
+                        extra['profiles'] = self.custom_profiles
+                    entries = list(self._entries) if self._entries is not None else None
+
+                if self.store is not None:
+                    if entries is not None:
+                        self.store.replace_all(entries)
+                    # Kept out of the manifest, they are bigger than the entries
+                    sidecars = {}
+                    if fingerprints is not None and version != self._saved_fingerprints:
+                        sidecars['fingerprints'] = fingerprints
+                    written = self.store.save(self._stored_root(), sidecars, **extra)
+                    if sidecars:
+                        self._saved_fingerprints = version
+                    if not quiet:
+                        output.status(f'wrote {len(written)} shard(s) to database', output.path(file))
+                else:
+                    if fingerprints:
+                        extra['fingerprints'] = fingerprints
+                    write_json_atomic(file, {'root': self._stored_root(), 'data': entries, **extra}, indent=4)
+                    # Shards of a database that was sharded before
+                    if os.path.isdir(shard_dir(file)):
+                        shutil.rmtree(shard_dir(file))
+                    if not quiet:
+                        output.status('wrote to database', output.path(file))
+                if file == self.file:
+                    self.saved_mtime = os.stat(file).st_mtime_ns
             except Exception as e:
-                output.error(f'Failed to write to database file ({escape(e)})')
+                output.error(f'Failed to write to database file ({escape(str(e))})')
+                return False
+        return True
+
+    def _checkpointer(self):
+        # Returns a function to call after each success, writes the database every so often
+        state = {'count': 0, 'time': time.monotonic()}
+        def checkpoint():
+            with self._lock:
+                state['count'] += 1
+                due = state['count'] >= self.checkpoint_every or time.monotonic() - state['time'] >= self.checkpoint_interval
+                if due:
+                    state['count'], state['time'] = 0, time.monotonic()
+            if due and self.modified:
+                self.modified = False
+                if not self.save_to(self.file, quiet=True):
+                    self.modified = True
+        return checkpoint
+
+    def _failed(self, url: str, error: str):
+        with self._lock:
+            record = self.failed.get(url, {'attempts': 0})
+            self.failed[url] = {'error': error.replace('ERROR: ', ''), 'attempts': record['attempts'] + 1}
+            self.modified = True
 
 
 
 
+    def _stored_root(self) -> str:
+        # Root as written to the database, relative to the database directory when inside it
+        if self.base:
+            try:
+                relative = os.path.relpath(self.root, self.base)
+            except ValueError: # different drives
+                return self.root
+            if not relative.startswith(os.pardir):
+                return relative
+        return self.root
+
     def _rename_entry(self, entry):
         _from = f"{entry['id']}.mp3"
         _to   = f"{file_name_from_title(entry['title'])}.mp3"
@@ -475,10 +912,125 @@ class YoutubeMM:
         _to   = os.path.join(self.root, _to)
         shutil.move(_from, _to)
 
-    def entry_path(self, entry):
-        return os.path.join(self.root, f"{file_name_from_title(entry['title'])}.mp3")
+    def _fetch(self, d: yt_dlp.YoutubeDL, url: str, extra_info: dict):
+        # Split metadata and media requests so metadata can be given priority
+        self.pacer.acquire(METADATA)
+        info = d.extract_info(url, download=False, process=False)
+        if info is None:
+            # Extractor error, already logged (`ignoreerrors`)
+            raise RuntimeError(f'could not get information of {url}')
+        self.pacer.acquire(MEDIA)
+        info = d.process_ie_result(info, download=True, extra_info=extra_info)
+        self.pacer.succeeded()
+        return info
+
+    @contextmanager
+    def _executor(self):
+        if self.executor is not None:
+            yield self.executor
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            yield executor
+
+    def is_downloaded(self, entry, profile: OutputProfile | None = None) -> bool:
+        path = self.entry_path(entry, profile)
+        if self.inventory is not None and self.inventory.root == os.path.dirname(path):
+            return os.path.basename(path) in self.inventory
+        return os.path.isfile(path)
+
+    def entry_path(self, entry, profile: OutputProfile | None = None):
+        entry = self._link_target(entry) or entry
+        profile = profile or self.profiles[DEFAULT_PROFILE]
+        return os.path.join(self.profile_root(profile), f"{file_name_from_title(entry['title'])}.{profile.ext}")
+
+    def profile(self, name: str) -> OutputProfile:
+        if name not in self.profiles:
+            raise ValueError(f'unknown output profile {name!r} (known: {', '.join(self.profiles)})')
+        return self.profiles[name]
+
+    def profile_root(self, profile: OutputProfile) -> str:
+        if profile.root:
+            return os.path.join(self.base, profile.root)
+        if profile.name == DEFAULT_PROFILE:
+            return self.root
+        return f'{self.root}-{profile.name}'
+
+    def _source(self, info: dict) -> str:
+        downloads = info.get('requested_downloads') or [{}]
+        source = downloads[0].get('filepath')
+        if source is None or not os.path.isfile(source):
+            # Just downloaded, not in the index yet
+            source = self.sources.find(info['id'], rescan=True)
+        if source is None:
+            raise RuntimeError(f"download of {info['id']} failed")
+        return source
+
+    def _produce(self, entry, source: str, profiles: list[OutputProfile]):
+        # Transcode the cached source into every profile, no network needed
+        metadata = {
+            'title':  entry['title'],
+            'artist': ', '.join(entry['artists']),
+            'album':  entry.get('album'),
+            'date':   entry.get('year'),
+        }
+        self.sources.touch(source)
+        for profile in profiles:
+            os.makedirs(self.profile_root(profile), exist_ok=True)
+            self._transcode(source, self.entry_path(entry, profile), profile, metadata)
+        # Profiles of an entry can be transcoded in parallel
+        with self._lock:
+            entry['variants'] = sorted(set(entry.get('variants', [])) | {p.name for p in profiles})
+
+    def _transcode(self, source: str, path: str, profile: OutputProfile, metadata: dict):
+        transcode(source, path, profile, metadata)
+
+    def _link_target(self, entry) -> dict | None:
+        if 'link' not in entry:
+            return None
+        return self.get_entry(entry['link'])
+
+    def _link_duplicate(self, entry, tracker: ProgressTracker, duration: float | None = None) -> bool:
+        # Fingerprint a freshly downloaded entry, duplicates link to the original instead of keeping a copy
+        entry.pop('link', None)
+        path = self.entry_path(entry)
+        if not os.path.isfile(path):
+            return False
+        fp = fingerprint(path, entry, duration)
+        with self._lock:
+            match = self.fingerprints.match(entry['id'], fp)
+            # Same title and length is left for `dedupe`, which asks first
+            original = self.get_entry(match[0]) if match and match[1] != 'title' else None
+            if original is None or 'link' in original:
+                self.fingerprints.add(entry['id'], fp)
+                self.modified = True
+                return False
+            self.fingerprints.remove(entry['id'])
+            entry['link'] = original['id']
+            entry.pop('variants', None)
+            tracker.linked.append((entry, original, match[1]))
+        for path in self._own_files(entry, original):
+            os.remove(path)
+        return True
+
+    def _own_files(self, entry, original: dict | None = None) -> list:
+        # Existing files of every profile of `entry` itself (not of the entry it links to), except those `original` uses
+        entry = {k: v for k, v in entry.items() if k != 'link'}
+        files = []
+        for profile in self.profiles.values():
+            path = self.entry_path(entry, profile)
+            if os.path.isfile(path) and (original is None or path != self.entry_path(original, profile)):
+                files.append(path)
+        return files
+
+    def _report(self, tracker: ProgressTracker):
+        for entry, original, reason in tracker.linked:
+            output.status('[cyan]linked', f'[i]{escape(entry['title'])}[/] =>', f'[i]{escape(original['title'])}[/]', f'({reason})')
+        for error in tracker.errors:
+            output.error(escape(error.replace('ERROR: ','')))
 
     def downloader(self, tracker: ProgressTracker):
+        pacer = self.pacer
+
         class MyLogger:
             def debug(self, msg):
                 # For compatibility with youtube-dl, both debug and info are passed into debug
@@ -491,9 +1043,11 @@ class YoutubeMM:
                 pass
 
             def warning(self, msg):
-                pass
+                # Retries are reported as warnings
+                pacer.check_message(msg)
 
             def error(self, msg):
+                pacer.check_message(msg)
                 tracker.save_error(msg)
 
         def progress_hook(d):
@@ -504,26 +1058,14 @@ class YoutubeMM:
             'logger': MyLogger(),
             'progress_hooks': [progress_hook] if tracker else [],
             'extract_flat': 'discard_in_playlist',
-            'final_ext': 'mp3',
             'format': 'bestaudio/best',
             'fragment_retries': 10,
             'ignoreerrors': 'only_download',
+            # Original streams go to the source cache, output profiles are transcoded from there
             'outtmpl': {
-                'default': os.path.join(self.root,'%(id)s.%(ext)s'),
+                'default': self.sources.template(),
             },
             'postprocessors': [
-                {
-                    'key': 'FFmpegExtractAudio',
-                    'nopostoverwrites': False,
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '5',
-                },
-                {
-                    'key': 'FFmpegMetadata',
-                    'add_chapters': True,
-                    'add_infojson': 'if_exists',
-                    'add_metadata': True,
-                },
                 {
                     'key': 'FFmpegConcat',
                     'only_multi_video': True,
@@ -531,6 +1073,11 @@ class YoutubeMM:
                 }
             ],
             'retries': 10,
+            'retry_sleep_functions': {
+                'http':      pacer.retry_sleep,
+                'fragment':  pacer.retry_sleep,
+                'extractor': pacer.retry_sleep,
+            },
         })
     
     """
@@ -569,8 +1116,8 @@ class YoutubeMM:
             tracker.progress.start_task(task_id)
             tracker.progress.update(task_id, completed=downloaded, total=total+1, description=entry['title'])
             if tracker.totalid is not None:
-                p = sum(t.percentage for t in tracker.progress.tasks[:-1])/tracker.n
-                max_width = max(len(t.description) if t.visible else 0 for t in tracker.progress.tasks)
+                p = sum(t.percentage for t in tracker.download_tasks())/tracker.n
+                max_width = max(len(t.description) if t.visible else 0 for t in tracker.download_tasks())
                 tracker.progress.update (
                     tracker.totalid,
                     description=line_text('Total', max_width),